@@ -0,0 +1,78 @@
+# alerts.py
+import numpy as np
+
+# Условия оповещений: бит состояния, колонка порога в alert_rules, поле hourly Open-Meteo
+RAIN, FROST, WIND = 1, 2, 4
+CONDITIONS = (
+    (RAIN, 'rain', 'rain_mm', 'precipitation'),
+    (FROST, 'frost', 'frost_c', 'temperature_2m'),
+    (WIND, 'wind', 'wind_ms', 'wind_speed_10m'),
+)
+HOURLY_FIELDS = ",".join(field for *_, field in CONDITIONS)
+
+# Сколько правил проверять за раз: матрица правила × часы не должна раздуваться
+CHUNK = 65536
+
+
+def hourly_matrix(payloads, cells, field, hours):
+    # Ячейки × часы; NaN там, где прогноза нет (сравнения с NaN всегда ложны)
+    matrix = np.full((len(cells), hours), np.nan)
+    for i, cell in enumerate(cells):
+        payload = payloads.get(cell)
+        if payload is not None:
+            values = payload['hourly'][field][:hours]
+            matrix[i, :len(values)] = np.array(values, dtype=float)
+    return matrix
+
+
+def evaluate(matrices, loc, thresholds, old_state, has_data):
+    # matrices: {имя: ячейки × часы}; loc: ячейка каждого правила; thresholds: {имя: порог правила, NaN — выключено}
+    # -> (новое состояние, биты для отправки, {имя: первый час срабатывания}, {имя: значение в этот час})
+    n = len(loc)
+    new_state = np.zeros(n, dtype=np.int64)
+    first = {name: np.zeros(n, dtype=np.int64) for _, name, _, _ in CONDITIONS}
+    value = {name: np.zeros(n) for _, name, _, _ in CONDITIONS}
+    for start in range(0, n, CHUNK):
+        part = slice(start, start + CHUNK)
+        rows = np.arange(min(n - start, CHUNK))
+        for bit, name, _, _ in CONDITIONS:
+            values = matrices[name][loc[part]]
+            limit = thresholds[name][part, None]
+            # Мороз — температура не выше порога, остальное — не ниже
+            hit = values <= limit if bit == FROST else values >= limit
+            hours = hit.argmax(axis=1)
+            new_state[part] |= np.where(hit.any(axis=1), bit, 0)
+            first[name][part] = hours
+            value[name][part] = values[rows, hours]
+    # Без прогноза состояние не меняем, иначе после сбоя API то же оповещение придёт повторно
+    new_state = np.where(has_data, new_state, old_state)
+    return new_state, new_state & ~old_state, first, value
+
+
+def check_rules(rules, payloads, cell_of, hours):
+    # rules — строки alert_rules, payloads — {ячейка: hourly-прогноз}.
+    # -> ([(правило, [(имя условия, "ЧЧ:ММ", значение)])] для отправки, [(новое состояние, chat_id)] изменений)
+    cells = list(dict.fromkeys(cell_of(rule) for rule in rules))
+    index = {cell: i for i, cell in enumerate(cells)}
+    loc = np.array([index[cell_of(rule)] for rule in rules], dtype=np.int64)
+    matrices = {name: hourly_matrix(payloads, cells, field, hours) for _, name, _, field in CONDITIONS}
+    thresholds = {
+        name: np.array([np.nan if rule[column] is None else rule[column] for rule in rules], dtype=float)
+        for _, name, column, _ in CONDITIONS
+    }
+    old_state = np.array([rule['state'] or 0 for rule in rules], dtype=np.int64)
+    has_data = np.array([cell in payloads for cell in cells], dtype=bool)[loc]
+
+    new_state, fire, first, value = evaluate(matrices, loc, thresholds, old_state, has_data)
+
+    alerts = []
+    for i in np.flatnonzero(fire):
+        rule = rules[i]
+        times = payloads[cells[loc[i]]]['hourly']['time']
+        fired = [
+            (name, times[first[name][i]][11:16], round(float(value[name][i]), 1))
+            for bit, name, _, _ in CONDITIONS if fire[i] & bit
+        ]
+        alerts.append((rule, fired))
+    changes = [(int(new_state[i]), rules[i]['chat_id']) for i in np.flatnonzero(new_state != old_state)]
+    return alerts, changes
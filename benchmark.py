@@ -0,0 +1,359 @@
+# benchmark.py
+# Нагрузочный бенчмарк рассылки и хендлеров на локальных заглушках Open-Meteo и Bot API.
+#
+#   python benchmark.py --chats 5000 --cities 40 --ticks 3 --om-latency 80 --tg-latency 30
+#
+# Ничего не уходит в сеть: база создаётся во временном каталоге, бот ходит только на 127.0.0.1.
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("METRICS_PORT", "0")
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+from aiogram.types import Update
+
+import bot as app
+import database
+from delivery import SendQueue
+from fsm_storage import SQLiteStorage
+
+CITY_NAMES = [
+    "Kyiv", "London", "Berlin", "Warsaw", "Paris", "Madrid", "Rome", "Vienna", "Prague", "Lviv",
+    "Odesa", "Kharkiv", "Dnipro", "Munich", "Hamburg", "Krakow", "Lyon", "Milan", "Porto", "Riga",
+]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class FakeServers:
+    # Заглушки Open-Meteo (forecast + geocoding) и Bot API с настраиваемой задержкой и ошибками
+    def __init__(self, om_latency, om_error_rate, tg_latency, tg_error_rate):
+        self.om_latency = om_latency
+        self.om_error_rate = om_error_rate
+        self.tg_latency = tg_latency
+        self.tg_error_rate = tg_error_rate
+        self.counts = {"forecast_requests": 0, "forecast_locations": 0, "geocoding_requests": 0, "telegram_requests": 0}
+        self.methods = {}
+        self.runner = None
+        self.port = None
+
+    def hourly(self, lat, lon, hours):
+        now = datetime.now().replace(minute=0, second=0, microsecond=0)
+        rnd = random.Random(f"{lat},{lon},{now:%Y%m%d%H}")
+        return {
+            "latitude": lat, "longitude": lon,
+            "hourly": {
+                "time": [(now + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M") for i in range(hours)],
+                "precipitation": [round(max(0, rnd.gauss(0, 1.5)), 1) for _ in range(hours)],
+                "temperature_2m": [round(rnd.uniform(-5, 25), 1) for _ in range(hours)],
+                "wind_speed_10m": [round(rnd.uniform(0, 16), 1) for _ in range(hours)],
+            },
+        }
+
+    def payload(self, lat, lon):
+        now = datetime.now()
+        days = [(now + timedelta(days=i)).strftime("%Y-%m-%d") for i in range(7)]
+        rnd = random.Random(f"{lat},{lon},{now:%Y%m%d%H}")
+        return {
+            "latitude": lat, "longitude": lon,
+            "current": {
+                "time": now.strftime("%Y-%m-%dT%H:00"),
+                "temperature_2m": round(rnd.uniform(-10, 30), 1),
+                "relative_humidity_2m": rnd.randint(30, 100),
+                "apparent_temperature": round(rnd.uniform(-15, 30), 1),
+                "weather_code": rnd.choice([0, 1, 2, 3, 45, 51, 61, 71, 95]),
+                "wind_speed_10m": round(rnd.uniform(0, 15), 1),
+            },
+            "daily": {
+                "time": days,
+                "weather_code": [rnd.choice([0, 3, 61]) for _ in days],
+                "temperature_2m_max": [round(rnd.uniform(5, 30), 1) for _ in days],
+                "temperature_2m_min": [round(rnd.uniform(-10, 5), 1) for _ in days],
+                "sunrise": [f"{d}T06:{rnd.randint(10, 59)}" for d in days],
+                "sunset": [f"{d}T18:{rnd.randint(10, 59)}" for d in days],
+                "precipitation_sum": [round(rnd.uniform(0, 10), 1) for _ in days],
+                "wind_speed_10m_max": [round(rnd.uniform(0, 20), 1) for _ in days],
+            },
+        }
+
+    async def forecast(self, request):
+        self.counts["forecast_requests"] += 1
+        await asyncio.sleep(self.om_latency / 1000)
+        if random.random() < self.om_error_rate:
+            return web.json_response({"error": True, "reason": "synthetic failure"}, status=500)
+        lats = [float(x) for x in request.query["latitude"].split(",")]
+        lons = [float(x) for x in request.query["longitude"].split(",")]
+        self.counts["forecast_locations"] += len(lats)
+        if "hourly" in request.query:
+            hours = int(request.query.get("forecast_hours", 24))
+            items = [self.hourly(lat, lon, hours) for lat, lon in zip(lats, lons)]
+        else:
+            items = [self.payload(lat, lon) for lat, lon in zip(lats, lons)]
+        return web.json_response(items[0] if len(items) == 1 else items)
+
+    async def geocoding(self, request):
+        self.counts["geocoding_requests"] += 1
+        await asyncio.sleep(self.om_latency / 1000)
+        name = request.query.get("name", "").strip().title()
+        if name not in CITY_NAMES:
+            return web.json_response({"generationtime_ms": 0.1})
+        i = CITY_NAMES.index(name)
+        return web.json_response({"results": [{
+            "name": name, "country": "Benchland", "country_code": "UA", "admin1": "Region",
+            "latitude": 45 + i * 0.7, "longitude": 10 + i * 1.3,
+        }]})
+
+    async def telegram(self, request):
+        method = request.match_info["method"]
+        self.counts["telegram_requests"] += 1
+        self.methods[method] = self.methods.get(method, 0) + 1
+        await asyncio.sleep(self.tg_latency / 1000)
+        if random.random() < self.tg_error_rate:
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+        data = dict(await request.post())
+        chat_id = int(data.get("chat_id", 0) or 0)
+        result = True
+        if method in ["sendMessage", "editMessageText"]:
+            result = {
+                "message_id": random.randint(1, 10 ** 6), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                "text": data.get("text", ""),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app_ = web.Application()
+        app_.router.add_get("/v1/forecast", self.forecast)
+        app_.router.add_get("/v1/search", self.geocoding)
+        app_.router.add_post("/bot{token}/{method}", self.telegram)
+        self.runner = web.AppRunner(app_)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        # Порт 0 — свободный порт от ОС; узнаём, какой достался
+        self.port = self.runner.addresses[0][1]
+        return f"http://127.0.0.1:{self.port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def seed_population(chats, cities, due_fraction, seed=42):
+    # N чатов на M городов: 40% каждые 2 ч, 20% каждые 12 ч, 40% ежедневно (пик на 7-9 утра).
+    # due_fraction подписок готовы к отправке прямо сейчас.
+    rnd = random.Random(seed)
+    now = datetime.now()
+    centers = [(rnd.uniform(35, 60), rnd.uniform(-10, 40)) for _ in range(cities)]
+    weights = [1 / (i + 1) for i in range(cities)]  # несколько крупных городов и длинный хвост
+    rows = []
+    for n in range(chats):
+        chat_id = n + 1 if rnd.random() < 0.8 else -(10 ** 12 + n)
+        city = rnd.choices(range(cities), weights)[0]
+        lat = centers[city][0] + rnd.uniform(-0.02, 0.02)
+        lon = centers[city][1] + rnd.uniform(-0.02, 0.02)
+        kind = rnd.random()
+        due = rnd.random() < due_fraction
+        if kind < 0.4:
+            interval, hour = 2, None
+        elif kind < 0.6:
+            interval, hour = 12, None
+        else:
+            interval = 24
+            hour = now.hour if due else rnd.choice([6, 7, 7, 8, 8, 8, 9, 12, 18, 21])
+        last_run = now - timedelta(days=1)
+        next_run = now - timedelta(minutes=1) if due else now + timedelta(hours=rnd.uniform(1, 12))
+        rows.append((
+            chat_id, "private" if chat_id > 0 else "group", rnd.choice(["en", "ru", "uk"]),
+            f"City{city}", "UA",
+            round(lat, 5), round(lon, 5), rnd.choice(["current", "daily"]), interval, hour,
+            database.default_phase(chat_id, interval) if interval != 24 else None, last_run, next_run
+        ))
+    return rows
+
+
+SQL_INSERT = """
+    INSERT INTO subscriptions
+    (chat_id, chat_type, lang_code, city_name, country_code, lat, lon, forecast_type, interval_hours, target_hour,
+     phase_minutes, last_run, next_run_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+# Прямые записи в обход database.py не оставляют версий, поэтому реестр бота перечитывается целиком
+async def insert_population(rows):
+    def _insert():
+        with database.get_conn() as conn:
+            conn.execute("DELETE FROM subscriptions")
+            conn.executemany(SQL_INSERT, rows)
+    await database.run(_insert)
+    await app.load_registry()
+
+
+async def make_all_due():
+    def _reset():
+        with database.get_conn() as conn:
+            conn.execute("UPDATE subscriptions SET next_run_at = ?", (datetime.now() - timedelta(minutes=1),))
+    await database.run(_reset)
+    await app.load_registry()
+
+
+def instrument_upstream(latencies):
+    # Время каждого запроса к Open-Meteo с точки зрения бота (для p50/p99)
+    original = app.fetch_json
+
+    async def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await original(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    app.fetch_json = timed
+
+
+async def run_ticks(args, tg_bot, servers):
+    queue = SendQueue(tg_bot, workers=app.SEND_WORKERS, global_rate=args.send_rate, group_rate=args.group_rate)
+    queue.start()
+    await app.lease_job()
+    results = []
+    for tick in range(args.ticks):
+        if tick > 0:
+            await make_all_due()
+            if args.cold:
+                app.forecast_cache.data.clear()
+                app.forecast_cache.bytes = 0
+        before = dict(servers.counts)
+        sent_before, failed_before = queue.sent, queue.failed
+        start = time.perf_counter()
+        await app.sender_job()
+        await app.outbox_job(queue)
+        duration = time.perf_counter() - start
+        sent = queue.sent - sent_before
+        results.append({
+            "tick": tick + 1,
+            "duration": duration,
+            "sent": sent,
+            "failed": queue.failed - failed_before,
+            "throughput": sent / duration if duration else 0,
+            "forecast_requests": servers.counts["forecast_requests"] - before["forecast_requests"],
+            "forecast_locations": servers.counts["forecast_locations"] - before["forecast_locations"],
+        })
+    await queue.stop()
+    return results
+
+
+async def replay_updates(args, tg_bot):
+    # Синтетический поток: пользователи пишут названия городов (разовый запрос)
+    dp = Dispatcher(storage=SQLiteStorage())
+    dp.include_router(app.router)
+    rnd = random.Random(7)
+    latencies = []
+    limit = asyncio.Semaphore(args.update_concurrency)
+
+    async def one(n):
+        text = rnd.choice(CITY_NAMES) if rnd.random() < 0.9 else f"Nowhere{n}"
+        update = Update.model_validate({
+            "update_id": n,
+            "message": {
+                "message_id": n, "date": int(time.time()),
+                "chat": {"id": 500000 + n % 2000, "type": "private"},
+                "from": {"id": 500000 + n % 2000, "is_bot": False, "first_name": "Bench", "language_code": "en"},
+                "text": text,
+            },
+        }, context={"bot": tg_bot})
+        async with limit:
+            start = time.perf_counter()
+            await dp.feed_update(tg_bot, update)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(n) for n in range(1, args.updates + 1)])
+    return latencies, time.perf_counter() - start
+
+
+async def main(args):
+    random.seed(args.seed)
+    servers = FakeServers(args.om_latency, args.om_error_rate, args.tg_latency, args.tg_error_rate)
+    base = await servers.start()
+    app.WEATHER_URL = f"{base}/v1/forecast"
+    app.GEOCODING_URL = f"{base}/v1/search"
+
+    workdir = tempfile.mkdtemp(prefix="weather-bench-")
+    await database.init_db(os.path.join(workdir, "bench.db"))
+    rows = seed_population(args.chats, args.cities, args.due_fraction, args.seed)
+    await insert_population(rows)
+
+    upstream = []
+    instrument_upstream(upstream)
+    tg_bot = Bot(
+        token=os.environ["BOT_TOKEN"],
+        session=AiohttpSession(api=TelegramAPIServer.from_base(base)),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+
+    print(f"Population: {args.chats} chats over {args.cities} cities, due fraction {args.due_fraction}")
+    print(f"Fake Open-Meteo: {args.om_latency} ms, errors {args.om_error_rate:.0%}; "
+          f"fake Bot API: {args.tg_latency} ms, errors {args.tg_error_rate:.0%}; send rate {args.send_rate}/s")
+    print()
+    try:
+        for r in await run_ticks(args, tg_bot, servers):
+            print(
+                f"tick {r['tick']}: {r['duration']:.2f}s, sent {r['sent']} ({r['throughput']:.1f} msg/s), "
+                f"failed {r['failed']}, forecast requests {r['forecast_requests']} "
+                f"for {r['forecast_locations']} locations"
+            )
+        if upstream:
+            print(f"upstream latency: p50 {percentile(upstream, 50) * 1000:.1f} ms, "
+                  f"p99 {percentile(upstream, 99) * 1000:.1f} ms over {len(upstream)} calls")
+
+        if args.updates:
+            upstream.clear()
+            latencies, duration = await replay_updates(args, tg_bot)
+            print(
+                f"updates: {len(latencies)} in {duration:.2f}s ({len(latencies) / duration:.1f}/s), "
+                f"handler p50 {percentile(latencies, 50) * 1000:.1f} ms, p99 {percentile(latencies, 99) * 1000:.1f} ms, "
+                f"geocoder calls {servers.counts['geocoding_requests']}"
+            )
+        print(f"telegram calls: {servers.methods}")
+    finally:
+        await tg_bot.session.close()
+        await app.close_http_session()
+        await database.close()
+        await servers.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load benchmark with local fake Open-Meteo and Bot API servers")
+    parser.add_argument("--chats", type=int, default=2000)
+    parser.add_argument("--cities", type=int, default=40)
+    parser.add_argument("--due-fraction", type=float, default=1.0)
+    parser.add_argument("--ticks", type=int, default=2)
+    parser.add_argument("--cold", action="store_true", help="clear the forecast cache between ticks")
+    parser.add_argument("--om-latency", type=float, default=50, help="ms")
+    parser.add_argument("--om-error-rate", type=float, default=0.0)
+    parser.add_argument("--tg-latency", type=float, default=20, help="ms")
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+    parser.add_argument("--send-rate", type=float, default=app.TELEGRAM_GLOBAL_RATE, help="messages per second")
+    parser.add_argument("--group-rate", type=float, default=app.TELEGRAM_GROUP_RATE, help="messages per minute per group")
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--update-concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
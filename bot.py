@@ -2,9 +2,15 @@ import asyncio
 import logging
 import sys
 import os
-import sqlite3
+import secrets
+import signal
+import socket
+import time
+import multiprocessing
 import aiohttp
 from datetime import datetime, timedelta
+from functools import partial
+from collections import Counter
 from dotenv import load_dotenv
 
 from aiogram import Bot, Dispatcher, Router, F, types
@@ -13,116 +19,323 @@ from aiogram.enums import ParseMode
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import (
+    InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+)
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 # Импорт локализации
-from locales import get_text, get_wmo, TEXTS
+from locales import get_text, TEXTS
+from render import get_flag, render_cached, report_cache
+from delivery import SendQueue, classify_error
+from webhook import WebhookServer
+from fsm_storage import SQLiteStorage
+from registry import SubscriptionRegistry
+from alerts import CONDITIONS, HOURLY_FIELDS, check_rules
+from catchup import plan as plan_catch_up
+from gazetteer import open_index as open_gazetteer
+from metrics import (
+    UPSTREAM_LATENCY, UPSTREAM_ERRORS, TICK_DURATION, DELIVERIES, PREWARMED, SEND_FAILURES, ALERTS_SENT, CATCHUP, OUTBOX,
+    CallbackMetric, HandlerMetricsMiddleware, start_metrics_server
+)
+from cache import TTLCache, ForecastCache
+from database import (
+    init_db, next_slot, save_subscription, get_subscription_changes, purge_tombstones,
+    delete_subscription, delivered_row, reschedule_subscriptions,
+    renew_leases, release_leases, claim_subscriptions, release_claims, set_active,
+    enqueue_outbox, claim_outbox, settle_outbox, release_outbox, purge_outbox,
+    save_alert_rule, get_alert_rule, delete_alert_rule, toggle_alert, get_alert_rules,
+    get_geocode, save_geocode, purge_geocode,
+    close as close_db
+)
 
 # --- КОНФИГУРАЦИЯ ---
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
-DB_FILE = "weather_bot_v2.db"
-
-# --- БАЗА ДАННЫХ ---
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS subscriptions (
-        chat_id INTEGER PRIMARY KEY,
-        chat_type TEXT,
-        lang_code TEXT,
-        city_name TEXT,
-        country_code TEXT,
-        lat REAL,
-        lon REAL,
-        forecast_type TEXT DEFAULT 'current',
-        interval_hours INTEGER,
-        target_hour INTEGER,
-        last_run TIMESTAMP
-    )
-    """)
-    conn.commit()
-    conn.close()
-
-def save_subscription(data):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    ftype = data.get('forecast_type', 'current')
-    
-    cur.execute("""
-        INSERT OR REPLACE INTO subscriptions 
-        (chat_id, chat_type, lang_code, city_name, country_code, lat, lon, forecast_type, interval_hours, target_hour, last_run)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        data['chat_id'], data['chat_type'], data['lang'], 
-        data['city'], data['country'], data['lat'], data['lon'], 
-        ftype,
-        data['interval'], data.get('target_hour'), 
-        datetime.now() - timedelta(days=1)
-    ))
-    conn.commit()
-    conn.close()
-
-def get_subscription(chat_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM subscriptions WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
-
-def get_all_subscriptions():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM subscriptions")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def delete_subscription(chat_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM subscriptions WHERE chat_id = ?", (chat_id,))
-    conn.commit()
-    conn.close()
-
-def update_last_run(chat_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("UPDATE subscriptions SET last_run = ? WHERE chat_id = ?", (datetime.now(), chat_id))
-    conn.commit()
-    conn.close()
+DB_FILE = os.getenv("DB_FILE", "weather_bot_v2.db")
+
+# Режим приёма обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "100"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Метрики Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 — выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))
+
+# Масштабирование рассылки: роль процесса, число процессов доставки и шардирование chat_id
+BOT_ROLE = os.getenv("BOT_ROLE", "all")
+DELIVERY_PROCESSES = int(os.getenv("DELIVERY_PROCESSES", "0"))
+WORKER_ID = os.getenv("WORKER_ID")
+SHARD_PARTITIONS = int(os.getenv("SHARD_PARTITIONS", "64"))
+LEASE_TTL = int(os.getenv("LEASE_TTL", "90"))
+CLAIM_TTL = int(os.getenv("CLAIM_TTL", "900"))
+CLAIM_LIMIT = int(os.getenv("CLAIM_LIMIT", "50000"))
+# Сколько отметок об отправке копить перед записью одной транзакцией
+DB_FLUSH_SIZE = int(os.getenv("DB_FLUSH_SIZE", "500"))
+
+# Адреса Open-Meteo (можно направить на свой инстанс или заглушку для бенчмарка)
+WEATHER_URL = os.getenv("WEATHER_URL", "https://api.open-meteo.com/v1/forecast")
+GEOCODING_URL = os.getenv("GEOCODING_URL", "https://geocoding-api.open-meteo.com/v1/search")
+
+# HTTP-клиент для Open-Meteo (один на весь процесс)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "30"))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", "30"))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))
+
+# Шаг сетки (в градусах): подписки в одной ячейке получают один общий прогноз
+GRID_RESOLUTION = float(os.getenv("GRID_RESOLUTION", "0.05"))
+# Сколько точек упаковывать в один запрос к forecast API
+WEATHER_BATCH_SIZE = int(os.getenv("WEATHER_BATCH_SIZE", "50"))
+
+# Кэш геокодера: в памяти (LRU + TTL) и в SQLite
+GEOCODE_CACHE_SIZE = int(os.getenv("GEOCODE_CACHE_SIZE", "5000"))
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", "21600"))
+GEOCODE_DB_TTL = int(os.getenv("GEOCODE_DB_TTL", str(30 * 86400)))
+
+# Кэш прогнозов: TTL по режимам (сек), бюджет памяти и окно отдачи устаревших данных
+FORECAST_TTL = {
+    'current': int(os.getenv("FORECAST_TTL_CURRENT", "600")),
+    'daily': int(os.getenv("FORECAST_TTL_DAILY", "3600")),
+    'weekly': int(os.getenv("FORECAST_TTL_WEEKLY", "10800")),
+}
+FORECAST_CACHE_MB = float(os.getenv("FORECAST_CACHE_MB", "32"))
+FORECAST_STALE_TTL = int(os.getenv("FORECAST_STALE_TTL", "300"))
+
+# Оповещения (/alerts): как часто проверять, на сколько часов вперёд смотреть и пороги по умолчанию
+ALERT_INTERVAL = int(os.getenv("ALERT_INTERVAL", "30"))
+ALERT_HOURS = int(os.getenv("ALERT_HOURS", "12"))
+ALERT_DEFAULTS = {
+    'rain': float(os.getenv("ALERT_RAIN_MM", "1.0")),
+    'frost': float(os.getenv("ALERT_FROST_C", "0")),
+    'wind': float(os.getenv("ALERT_WIND_MS", "12")),
+}
+
+# Реестр подписок в памяти: как часто подтягивать изменения других процессов (сек)
+# и сколько хранить отметки об удалённых подписках
+REGISTRY_SYNC = int(os.getenv("REGISTRY_SYNC", "10"))
+TOMBSTONE_TTL = int(os.getenv("TOMBSTONE_TTL", "86400"))
+
+# Временные ошибки отправки: повтор через SEND_RETRY_BASE * 2^n сек (не больше SEND_RETRY_MAX);
+# после SEND_FAIL_LIMIT брошенных сообщений подряд подписка отключается (0 — никогда)
+SEND_RETRY_BASE = int(os.getenv("SEND_RETRY_BASE", "60"))
+SEND_RETRY_MAX = int(os.getenv("SEND_RETRY_MAX", "21600"))
+SEND_FAIL_LIMIT = int(os.getenv("SEND_FAIL_LIMIT", "20"))
+
+# Outbox (таблица готовых сообщений): сколько строк забирать за раз, как часто проверять (сек),
+# через сколько секунд неотправленное сообщение устаревает и сколько хранить отправленные ради дедупликации
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "200"))
+OUTBOX_POLL = int(os.getenv("OUTBOX_POLL", "2"))
+OUTBOX_TTL = int(os.getenv("OUTBOX_TTL", "3600"))
+OUTBOX_RETENTION = int(os.getenv("OUTBOX_RETENTION", "86400"))
+
+# Прогрев: за сколько минут до отправки заранее брать прогнозы и с какой скоростью (ячеек/сек).
+# PREWARM_SLACK — запас на задержку тика и саму рассылку, чтобы прогноз не устарел к отправке
+PREWARM_MINUTES = int(os.getenv("PREWARM_MINUTES", "15"))
+PREWARM_RATE = float(os.getenv("PREWARM_RATE", "5"))
+PREWARM_SLACK = int(os.getenv("PREWARM_SLACK", "120"))
+
+# Отправки, пропущенные за время простоя (см. catchup.py): политика drop / coalesce / replay,
+# окно (сек), по которому распределяются догоняющие сообщения, и с какой просрочки (сек) отправка считается пропущенной
+CATCHUP_POLICY = os.getenv("CATCHUP_POLICY", "coalesce")
+CATCHUP_WINDOW = int(os.getenv("CATCHUP_WINDOW", "1800"))
+CATCHUP_GRACE = int(os.getenv("CATCHUP_GRACE", "300"))
+
+# Незавершённые диалоги /setup и поиска живут столько секунд без активности
+FSM_TTL = int(os.getenv("FSM_TTL", "86400"))
+
+# Локальный справочник городов (см. gazetteer.py); без файла поиск идёт через геокодер
+GAZETTEER_FILE = os.getenv("GAZETTEER_FILE", "gazetteer.idx")
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "10"))
+
+# Кэш списков админов групп (сек)
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", "10000"))
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "600"))
+
+# Доставка: параллельные запросы прогнозов и лимиты Telegram
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "16"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", "20"))
 
 # --- API ---
+http_session = None
+geocode_cache = TTLCache(GEOCODE_CACHE_SIZE, GEOCODE_CACHE_TTL)
+geocode_stats = Counter()
+gazetteer = None
+admin_cache = TTLCache(ADMIN_CACHE_SIZE, ADMIN_CACHE_TTL)
+forecast_cache = ForecastCache(int(FORECAST_CACHE_MB * 1024 * 1024), stale_ttl=FORECAST_STALE_TTL)
+
+CallbackMetric(
+    "weather_cache_requests_total", "Cache lookups by cache and result",
+    lambda: {
+        ("geocode", "hit"): geocode_cache.hits,
+        ("geocode", "gazetteer"): geocode_stats['gazetteer'],
+        ("geocode", "db_hit"): geocode_stats['db_hits'],
+        ("geocode", "miss"): geocode_stats['misses'],
+        ("forecast", "hit"): forecast_cache.hits,
+        ("forecast", "stale"): forecast_cache.stale_hits,
+        ("forecast", "miss"): forecast_cache.misses,
+        ("report", "hit"): report_cache.hits,
+        ("report", "miss"): report_cache.misses,
+        ("admins", "hit"): admin_cache.hits,
+        ("admins", "miss"): admin_cache.misses,
+    },
+    labels=("cache", "result"), type="counter"
+)
+CallbackMetric(
+    "weather_cache_entries", "Entries currently held by each cache",
+    lambda: {
+        ("geocode",): len(geocode_cache), ("forecast",): len(forecast_cache),
+        ("report",): len(report_cache), ("admins",): len(admin_cache)
+    },
+    labels=("cache",)
+)
+
+def create_http_session():
+    # Keep-alive пул соединений с кэшем DNS: без нового TLS-рукопожатия на каждый запрос
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        ttl_dns_cache=HTTP_DNS_TTL,
+        use_dns_cache=True
+    )
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+def normalize_query(text):
+    return " ".join(text.casefold().split())
+
+async def fetch_json(api, kind, url, params, check=True):
+    try:
+        with UPSTREAM_LATENCY.time(api=api, kind=kind):
+            async with get_http_session().get(url, params=params) as resp:
+                if check:
+                    resp.raise_for_status()
+                return await resp.json()
+    except Exception:
+        UPSTREAM_ERRORS.inc(api=api)
+        raise
+
+async def fetch_cities(city_name, lang_code):
+    params = {"name": city_name, "count": 5, "language": lang_code, "format": "json"}
+    data = await fetch_json("geocoding", "search", GEOCODING_URL, params, check=False)
+    if "results" not in data: return []
+    return data["results"]
+
 async def search_cities(city_name, lang_code):
     if lang_code not in ['ru', 'uk', 'en', 'de', 'fr', 'pl']: 
         lang_code = 'en'
-    url = f"https://geocoding-api.open-meteo.com/v1/search?name={city_name}&count=5&language={lang_code}&format=json"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            data = await resp.json()
-            if "results" not in data: return []
-            return data["results"]
-
-async def get_weather(lat, lon, mode='current'):
-    if mode == 'daily':
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=weather_code,temperature_2m_max,temperature_2m_min,sunrise,sunset,precipitation_sum,wind_speed_10m_max&current=temperature_2m,apparent_temperature&wind_speed_unit=ms&timezone=auto&forecast_days=1"
-    elif mode == 'weekly':
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=weather_code,temperature_2m_max,temperature_2m_min&timezone=auto&forecast_days=7"
+    # Сначала локальный справочник: точное совпадение названия без сетевого запроса
+    if gazetteer is not None:
+        cities = gazetteer.search(city_name, lang_code)
+        if cities:
+            geocode_stats['gazetteer'] += 1
+            return cities
+    # Два уровня кэша: LRU в памяти, затем таблица geocode_cache, и только потом сеть
+    key = (normalize_query(city_name), lang_code)
+    cities = geocode_cache.get(key)
+    if cities is not None:
+        return cities
+    cities = await get_geocode(key[0], lang_code, GEOCODE_DB_TTL)
+    if cities is not None:
+        geocode_stats['db_hits'] += 1
     else:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,apparent_temperature,weather_code,wind_speed_10m&wind_speed_unit=ms&timezone=auto"
-        
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            data = await resp.json()
-            if mode in ['daily', 'weekly']:
-                return data
-            else:
-                return data.get('current')
+        geocode_stats['misses'] += 1
+        cities = await fetch_cities(city_name, lang_code)
+        # Пустой результат (опечатки, болтовня в группах) держим только в памяти
+        if cities:
+            await save_geocode(key[0], lang_code, cities)
+    geocode_cache.set(key, cities)
+    return cities
+
+# Один «полный» запрос на точку: объединение полей всех режимов на 7 дней.
+# current/daily/weekly собираются из него локально (см. render.py).
+WEATHER_PARAMS = {
+    "current": "temperature_2m,relative_humidity_2m,apparent_temperature,weather_code,wind_speed_10m",
+    "daily": "weather_code,temperature_2m_max,temperature_2m_min,sunrise,sunset,precipitation_sum,wind_speed_10m_max",
+    "wind_speed_unit": "ms", "timezone": "auto", "forecast_days": 7
+}
+
+async def get_weather(lat, lon):
+    params = dict(WEATHER_PARAMS, latitude=lat, longitude=lon)
+    return await fetch_json("forecast", "single", WEATHER_URL, params)
+
+async def fetch_weather_chunk(locations, base_params=WEATHER_PARAMS, kind="batch"):
+    params = dict(
+        base_params,
+        latitude=",".join(str(lat) for lat, _ in locations),
+        longitude=",".join(str(lon) for _, lon in locations)
+    )
+    data = await fetch_json("forecast", kind, WEATHER_URL, params)
+    # Для одной точки API отдаёт объект, для нескольких — список в том же порядке
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) != len(locations):
+        raise ValueError(f"expected {len(locations)} results, got {len(data)}")
+    return dict(zip(locations, data))
+
+# Прогноз для многих точек: до WEATHER_BATCH_SIZE координат в одном запросе.
+# Возвращает {(lat, lon): payload}; точки, которые не удалось получить, отсутствуют.
+async def get_weather_batch(locations):
+    locations = list(dict.fromkeys(locations))
+    results = {}
+    for i in range(0, len(locations), WEATHER_BATCH_SIZE):
+        chunk = locations[i:i + WEATHER_BATCH_SIZE]
+        try:
+            results.update(await fetch_weather_chunk(chunk))
+            continue
+        except Exception as e:
+            logging.warning(f"Batch weather request failed ({len(chunk)} locations): {e}")
+        # Запасной вариант: по одному запросу на точку
+        for lat, lon in chunk:
+            try:
+                results[(lat, lon)] = await get_weather(lat, lon)
+            except Exception as e:
+                logging.error(f"Error fetching weather for {(lat, lon)}: {e}")
+    return results
+
+# Почасовой прогноз для оповещений: отдельный лёгкий запрос, без кэша (проверка раз в ALERT_INTERVAL)
+ALERT_PARAMS = {"hourly": HOURLY_FIELDS, "wind_speed_unit": "ms", "timezone": "auto", "forecast_hours": ALERT_HOURS}
+
+async def get_hourly_batch(locations):
+    try:
+        return await fetch_weather_chunk(locations, ALERT_PARAMS, "hourly")
+    except Exception as e:
+        logging.warning(f"Hourly forecast request failed ({len(locations)} locations): {e}")
+        return {}
+
+# Разовые запросы: из кэша по ячейке сетки, устаревшее — с фоновым обновлением
+async def get_forecast(lat, lon, mode='current'):
+    cell = grid_cell(lat, lon)
+    return await forecast_cache.get_or_fetch(cell, partial(get_weather, cell[0], cell[1]), FORECAST_TTL[mode])
+
+# Рассылка: свежее из кэша, остальное пакетными запросами.
+# cells: {cell: ttl} — для ячейки берётся самый строгий TTL среди её режимов.
+async def get_forecasts(cells):
+    return await forecast_cache.get_many(cells, get_weather_batch)
 
 # --- СТЕЙТЫ И УТИЛИТЫ ---
 class SetupState(StatesGroup):
@@ -138,9 +351,53 @@ class OneTimeState(StatesGroup):
 
 router = Router()
 
-def get_flag(country_code):
-    if not country_code: return "🌍"
-    return chr(127397 + ord(country_code[0])) + chr(127397 + ord(country_code[1]))
+def grid_cell(lat, lon):
+    if GRID_RESOLUTION <= 0:
+        return (lat, lon)
+    return (
+        round(round(lat / GRID_RESOLUTION) * GRID_RESOLUTION, 4),
+        round(round(lon / GRID_RESOLUTION) * GRID_RESOLUTION, 4)
+    )
+
+# Подписки в памяти процесса (registry.py): запись — в SQLite и сразу в реестр,
+# чужие изменения — по версиям через sync_registry. Lock не даёт старому снимку затереть свежую запись.
+registry = SubscriptionRegistry(grid_cell)
+registry_lock = asyncio.Lock()
+
+CallbackMetric("weather_registry_subscriptions", "Subscriptions held in the in-memory registry", lambda: {(): len(registry)})
+
+async def sync_registry():
+    async with registry_lock:
+        rows, tombstones, version = await get_subscription_changes(registry.version)
+        registry.apply(rows, tombstones, version)
+
+async def load_registry():
+    async with registry_lock:
+        registry.clear()
+    await sync_registry()
+    logging.info(f"Loaded {len(registry)} subscriptions")
+
+async def store_subscription(data):
+    async with registry_lock:
+        registry.upsert(await save_subscription(data))
+
+async def remove_subscription(chat_id):
+    async with registry_lock:
+        await delete_subscription(chat_id)
+        registry.remove(chat_id)
+
+# Админы чатов: множество user id на чат, кэш с TTL, сбрасывается по chat_member
+async def is_chat_admin(bot: Bot, chat_id, user_id):
+    admins = admin_cache.get(chat_id)
+    if admins is None:
+        members = await bot.get_chat_administrators(chat_id)
+        admins = frozenset(m.user.id for m in members)
+        admin_cache.set(chat_id, admins)
+    return user_id in admins
+
+# В состоянии FSM храним только то, что нужно после выбора: [name, country_code, lat, lon]
+def compact_cities(cities):
+    return [[c['name'], c.get('country_code', 'XX'), c['latitude'], c['longitude']] for c in cities[:5]]
 
 def get_user_lang(user: types.User):
     if not user or not user.language_code: return 'en'
@@ -149,6 +406,17 @@ def get_user_lang(user: types.User):
 
 # --- ХЕНДЛЕРЫ КОМАНД ---
 
+@router.chat_member()
+@router.my_chat_member()
+async def on_chat_member_update(event: types.ChatMemberUpdated):
+    admin_statuses = ['administrator', 'creator']
+    if event.old_chat_member.status in admin_statuses or event.new_chat_member.status in admin_statuses:
+        admin_cache.pop(event.chat.id)
+    # Бота заблокировали / удалили из группы — рассылку выключаем, вернули — включаем снова
+    if event.new_chat_member.user.id == event.bot.id:
+        if await set_active(event.chat.id, event.new_chat_member.status not in ['kicked', 'left']):
+            logging.info(f"Subscription {event.chat.id} is now {event.new_chat_member.status}")
+
 @router.message(Command("start"))
 async def cmd_start(message: types.Message):
     lang = get_user_lang(message.from_user)
@@ -162,17 +430,34 @@ async def cmd_help(message: types.Message):
 @router.message(Command("setup"))
 async def cmd_setup(message: types.Message, state: FSMContext):
     if message.chat.type in ['group', 'supergroup', 'channel']:
-        admins = await message.bot.get_chat_administrators(message.chat.id)
-        if message.from_user.id not in [a.user.id for a in admins]:
+        if not await is_chat_admin(message.bot, message.chat.id, message.from_user.id):
             await message.answer(get_text('en', "only_admin"))
             return
     
     lang = get_user_lang(message.from_user)
-    await state.update_data(lang=lang, chat_id=message.chat.id, chat_type=message.chat.type)
+    # Новый диалог начинаем с чистых данных: флаг alerts от брошенного /alerts не должен остаться
+    await state.set_data({'lang': lang, 'chat_id': message.chat.id, 'chat_type': message.chat.type})
     
     await state.set_state(SetupState.waiting_city_input)
     await message.answer(get_text(lang, "setup_start"))
 
+@router.message(Command("alerts"))
+async def cmd_alerts(message: types.Message, state: FSMContext):
+    if message.chat.type in ['group', 'supergroup', 'channel']:
+        if not await is_chat_admin(message.bot, message.chat.id, message.from_user.id):
+            await message.answer(get_text('en', "only_admin"))
+            return
+
+    lang = get_user_lang(message.from_user)
+    rule = await get_alert_rule(message.chat.id)
+    if rule:
+        await message.answer(alerts_text(rule, lang), reply_markup=alerts_keyboard(rule, lang))
+        return
+    # Оповещений ещё нет: сначала город, как в /setup
+    await state.set_data({'lang': lang, 'chat_id': message.chat.id, 'chat_type': message.chat.type, 'alerts': True})
+    await state.set_state(SetupState.waiting_city_input)
+    await message.answer(get_text(lang, "setup_start"))
+
 # --- ОБРАБОТКА ТЕКСТА (РАЗОВЫЙ ЗАПРОС) ---
 @router.message(F.text & ~F.text.startswith("/"), StateFilter(None))
 async def process_text_search(message: types.Message, state: FSMContext):
@@ -184,17 +469,17 @@ async def process_text_search(message: types.Message, state: FSMContext):
             await message.answer(get_text(lang, "city_not_found"))
         return
 
-    await state.update_data(lang=lang, cities_cache=cities)
+    await state.update_data(lang=lang, cities=compact_cities(cities))
     
     kb_builder = []
-    for city in cities[:5]:
+    for idx, city in enumerate(cities[:5]):
         flag = get_flag(city.get("country_code", "XX"))
         country = city.get("country", "")
         name = city.get("name", "")
         region = city.get("admin1", "")
         btn_text = f"{flag} {name}, {country}"
         if region: btn_text += f" ({region})"
-        kb_builder.append([InlineKeyboardButton(text=btn_text, callback_data=f"ot_city_{cities.index(city)}")])
+        kb_builder.append([InlineKeyboardButton(text=btn_text, callback_data=f"ot_city_{idx}")])
     
     await message.answer(get_text(lang, "choose_city"), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_builder))
     await state.set_state(OneTimeState.waiting_city_selection)
@@ -205,14 +490,9 @@ async def process_text_search(message: types.Message, state: FSMContext):
 async def process_onetime_city(callback: CallbackQuery, state: FSMContext):
     idx = int(callback.data.split("_")[2])
     data = await state.get_data()
-    selected_city = data['cities_cache'][idx]
+    name, country, lat, lon = data['cities'][idx]
     
-    await state.update_data(
-        city=selected_city['name'],
-        country=selected_city.get('country_code', 'XX'),
-        lat=selected_city['latitude'],
-        lon=selected_city['longitude']
-    )
+    await state.update_data(cities=None, city=name, country=country, lat=lat, lon=lon)
     
     lang = data['lang']
     # В разовом запросе ОСТАВЛЯЕМ 3 кнопки
@@ -232,57 +512,9 @@ async def process_onetime_result(callback: CallbackQuery, state: FSMContext):
     lang = data['lang']
     
     try:
-        w = await get_weather(data['lat'], data['lon'], ftype)
-        
-        if ftype == 'daily':
-            daily = w['daily']
-            curr = w['current']
-            msg = get_text(
-                lang, "daily_msg",
-                city=data['city'],
-                country=get_flag(data['country']),
-                desc=get_wmo(daily['weather_code'][0], lang),
-                t_now=curr['temperature_2m'],
-                t_feels=curr['apparent_temperature'],
-                t_max=daily['temperature_2m_max'][0],
-                t_min=daily['temperature_2m_min'][0],
-                rain=daily['precipitation_sum'][0],
-                wind=daily['wind_speed_10m_max'][0],
-                sunrise=daily['sunrise'][0].split('T')[1],
-                sunset=daily['sunset'][0].split('T')[1]
-            )
-        elif ftype == 'weekly':
-            daily = w['daily']
-            lines = []
-            for i in range(7):
-                dt = datetime.strptime(daily['time'][i], "%Y-%m-%d")
-                short_date = dt.strftime("%d.%m")
-                w_code = daily['weather_code'][i]
-                t_max = daily['temperature_2m_max'][i]
-                t_min = daily['temperature_2m_min'][i]
-                
-                desc_full = get_wmo(w_code, lang)
-                emoji = desc_full.split()[0]
-                
-                lines.append(f"▪️ {short_date}: {emoji} <b>{t_min}°C</b> … <b>{t_max}°C</b>")
-            
-            msg = get_text(
-                lang, "weekly_msg",
-                city=data['city'],
-                country=get_flag(data['country']),
-                forecast_text="\n".join(lines)
-            )
-        else:
-            msg = get_text(
-                lang, "weather_msg",
-                city=data['city'],
-                country=get_flag(data['country']),
-                desc=get_wmo(w['weather_code'], lang),
-                temp=w['temperature_2m'],
-                feels=w['apparent_temperature'],
-                wind=w['wind_speed_10m'],
-                hum=w['relative_humidity_2m']
-            )
+        cell = grid_cell(data['lat'], data['lon'])
+        payload = await get_forecast(data['lat'], data['lon'], ftype)
+        msg = render_cached(cell, payload, ftype, lang, data['city'], data['country'])
         
         await callback.message.edit_text(msg)
     except Exception as e:
@@ -292,16 +524,69 @@ async def process_onetime_result(callback: CallbackQuery, state: FSMContext):
     await state.clear()
 
 
+# --- INLINE-РЕЖИМ (@bot город) ---
+# Подсказки городов из локального справочника; в кнопках — номер записи в индексе,
+# поэтому после пересборки gazetteer.idx старые inline-сообщения могут указывать на другой город.
+
+@router.inline_query()
+async def inline_city_search(query: InlineQuery):
+    if gazetteer is None or not query.query.strip():
+        await query.answer([], cache_time=300, is_personal=True)
+        return
+    lang = get_user_lang(query.from_user)
+    results = []
+    for city in gazetteer.search(query.query, lang, limit=INLINE_RESULTS, prefix=True):
+        flag = get_flag(city['country_code'])
+        place = ", ".join(part for part in [city['admin1'], city['country']] if part)
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=get_text(lang, "btn_current"), callback_data=f"gz_current_{city['id']}")],
+            [InlineKeyboardButton(text=get_text(lang, "btn_daily"), callback_data=f"gz_daily_{city['id']}")],
+            [InlineKeyboardButton(text=get_text(lang, "btn_weekly"), callback_data=f"gz_weekly_{city['id']}")]
+        ])
+        results.append(InlineQueryResultArticle(
+            id=str(city['id']),
+            title=f"{flag} {city['name']}",
+            description=place,
+            input_message_content=InputTextMessageContent(
+                message_text=f"{flag} <b>{city['name']}</b>, {place}\n{get_text(lang, 'choose_type_once')}"
+            ),
+            reply_markup=kb
+        ))
+    await query.answer(results, cache_time=300, is_personal=True)
+
+@router.callback_query(F.data.startswith("gz_"))
+async def inline_city_result(callback: CallbackQuery):
+    _, ftype, idx = callback.data.split("_")
+    lang = get_user_lang(callback.from_user)
+    if gazetteer is None or not 0 <= int(idx) < len(gazetteer):
+        await callback.answer()
+        return
+    city = gazetteer.city(int(idx), lang)
+
+    try:
+        cell = grid_cell(city['latitude'], city['longitude'])
+        payload = await get_forecast(city['latitude'], city['longitude'], ftype)
+        msg = render_cached(cell, payload, ftype, lang, city['name'], city['country_code'])
+    except Exception as e:
+        logging.error(f"Error in inline result: {e}")
+        msg = "⚠️ Error fetching weather."
+    # Сообщения, отправленные через inline, редактируются по inline_message_id
+    if callback.inline_message_id:
+        await callback.bot.edit_message_text(msg, inline_message_id=callback.inline_message_id)
+    else:
+        await callback.message.edit_text(msg)
+    await callback.answer()
+
+
 # --- НАСТРОЙКИ И SETUP ---
 @router.message(Command("settings"))
 async def cmd_settings(message: types.Message, state: FSMContext):
     if message.chat.type in ['group', 'supergroup', 'channel']:
-        admins = await message.bot.get_chat_administrators(message.chat.id)
-        if message.from_user.id not in [a.user.id for a in admins]:
+        if not await is_chat_admin(message.bot, message.chat.id, message.from_user.id):
             await message.answer(get_text('en', "only_admin"))
             return
 
-    sub = get_subscription(message.chat.id)
+    sub = registry.get(message.chat.id)
     lang = get_user_lang(message.from_user)
 
     if not sub:
@@ -323,6 +608,9 @@ async def cmd_settings(message: types.Message, state: FSMContext):
         type_display = get_text(lang, "btn_current")
 
     text = get_text(lang, "settings_title", city=sub['city_name'], type=type_display, schedule=sched)
+    # Подписка отключена после неудачных отправок (или бота заблокировали) — говорим, как включить
+    if not sub['active']:
+        text += get_text(lang, "settings_paused")
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=get_text(lang, "btn_change_city"), callback_data="set_city")],
@@ -332,22 +620,54 @@ async def cmd_settings(message: types.Message, state: FSMContext):
     
     await message.answer(text, reply_markup=kb)
 
+# --- ОПОВЕЩЕНИЯ ---
+
+def alerts_text(rule, lang):
+    return get_text(lang, "alerts_title", city=rule['city_name'], hours=ALERT_HOURS)
+
+def alerts_keyboard(rule, lang):
+    # Кнопка на условие: ✅ включено (с порогом правила), ▫️ выключено (с порогом по умолчанию)
+    buttons = []
+    for _, name, column, _ in CONDITIONS:
+        enabled = rule[column] is not None
+        value = rule[column] if enabled else ALERT_DEFAULTS[name]
+        text = get_text(lang, f"alert_rule_{name}", val=f"{value:g}")
+        buttons.append([InlineKeyboardButton(text=("✅ " if enabled else "▫️ ") + text, callback_data=f"al_{name}")])
+    buttons.append([InlineKeyboardButton(text=get_text(lang, "btn_alert_stop"), callback_data="al_stop")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@router.callback_query(F.data.startswith("al_"))
+async def alerts_toggle(callback: CallbackQuery):
+    lang = get_user_lang(callback.from_user)
+    chat_id = callback.message.chat.id
+    name = callback.data[3:]
+    if name == 'stop':
+        await delete_alert_rule(chat_id)
+        await callback.message.edit_text(get_text(lang, "alerts_off"))
+        return
+    condition = next((c for c in CONDITIONS if c[1] == name), None)
+    rule = await toggle_alert(chat_id, condition[2], ALERT_DEFAULTS[name], condition[0]) if condition else None
+    if rule is None:
+        await callback.answer()
+        return
+    await callback.message.edit_text(alerts_text(rule, lang), reply_markup=alerts_keyboard(rule, lang))
+
 @router.callback_query(F.data == "set_stop")
 async def settings_stop(callback: CallbackQuery):
     lang = get_user_lang(callback.from_user)
-    delete_subscription(callback.message.chat.id)
+    await remove_subscription(callback.message.chat.id)
     await callback.message.edit_text(get_text(lang, "stop_success"))
 
 @router.callback_query(F.data == "set_city")
 async def settings_city(callback: CallbackQuery, state: FSMContext):
     lang = get_user_lang(callback.from_user)
-    await state.update_data(lang=lang, chat_id=callback.message.chat.id, chat_type=callback.message.chat.type)
+    await state.set_data({'lang': lang, 'chat_id': callback.message.chat.id, 'chat_type': callback.message.chat.type})
     await state.set_state(SetupState.waiting_city_input)
     await callback.message.edit_text(get_text(lang, "setup_start"))
 
 @router.callback_query(F.data == "set_time")
 async def settings_time(callback: CallbackQuery, state: FSMContext):
-    sub = get_subscription(callback.message.chat.id)
+    sub = registry.get(callback.message.chat.id)
     lang = get_user_lang(callback.from_user)
     
     if not sub:
@@ -388,16 +708,16 @@ async def process_city_search(message: types.Message, state: FSMContext):
         return
 
     kb_builder = []
-    for city in cities[:5]:
+    for idx, city in enumerate(cities[:5]):
         flag = get_flag(city.get("country_code", "XX"))
         country = city.get("country", "")
         name = city.get("name", "")
         region = city.get("admin1", "")
         btn_text = f"{flag} {name}, {country}"
         if region: btn_text += f" ({region})"
-        kb_builder.append([InlineKeyboardButton(text=btn_text, callback_data=f"city_{cities.index(city)}")])
+        kb_builder.append([InlineKeyboardButton(text=btn_text, callback_data=f"city_{idx}")])
     
-    await state.update_data(cities_cache=cities)
+    await state.update_data(cities=compact_cities(cities))
     await message.answer(get_text(lang, "choose_city"), reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_builder))
     await state.set_state(SetupState.waiting_city_selection)
 
@@ -405,16 +725,18 @@ async def process_city_search(message: types.Message, state: FSMContext):
 async def process_city_selection(callback: CallbackQuery, state: FSMContext):
     idx = int(callback.data.split("_")[1])
     data = await state.get_data()
-    selected_city = data['cities_cache'][idx]
+    name, country, lat, lon = data['cities'][idx]
     
-    await state.update_data(
-        city=selected_city['name'],
-        country=selected_city.get('country_code', 'XX'),
-        lat=selected_city['latitude'],
-        lon=selected_city['longitude']
-    )
+    await state.update_data(cities=None, city=name, country=country, lat=lat, lon=lon)
     
     lang = data['lang']
+
+    if data.get('alerts'):
+        data.update(city=name, country=country, lat=lat, lon=lon)
+        rule = await save_alert_rule(data, tuple(ALERT_DEFAULTS[name] for _, name, _, _ in CONDITIONS))
+        await callback.message.edit_text(alerts_text(rule, lang), reply_markup=alerts_keyboard(rule, lang))
+        await state.clear()
+        return
     
     # ИЗМЕНЕНИЕ: В настройках ПОДПИСКИ теперь только 2 кнопки
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -455,7 +777,7 @@ async def process_interval_choice(callback: CallbackQuery, state: FSMContext):
         await callback.message.edit_text(get_text(lang, "ask_time"))
         await state.set_state(SetupState.waiting_time)
     else:
-        save_subscription(data)
+        await store_subscription(data)
         await callback.message.edit_text(get_text(lang, "done_interval", city=data['city'], val=interval))
         await state.clear()
 
@@ -471,97 +793,401 @@ async def process_time_input(message: types.Message, state: FSMContext):
         return
 
     data['target_hour'] = hour
-    save_subscription(data)
+    await store_subscription(data)
     await message.answer(get_text(lang, "done_daily", city=data['city'], val=hour))
     await state.clear()
 
-async def sender_job(bot: Bot):
-    subs = get_all_subscriptions()
+async def alerts_job():
+    # Все правила своих партиций за раз: почасовой прогноз пачками по ячейкам,
+    # пороги проверяются матрицей (alerts.py), сообщение — только когда условие стало истинным
+    if not owned_partitions:
+        return
+    rules = await get_alert_rules(owned_partitions, SHARD_PARTITIONS)
+    if not rules:
+        return
+    start = datetime.now()
+
+    def cell_of(rule):
+        return grid_cell(rule['lat'], rule['lon'])
+
+    cells = list(dict.fromkeys(map(cell_of, rules)))
+    fetch_limit = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    async def fetch(chunk):
+        async with fetch_limit:
+            return await get_hourly_batch(chunk)
+
+    payloads = {}
+    for result in await asyncio.gather(*[
+        fetch(cells[i:i + WEATHER_BATCH_SIZE]) for i in range(0, len(cells), WEATHER_BATCH_SIZE)
+    ]):
+        payloads.update(result)
+
+    alerts, changes = check_rules(rules, payloads, cell_of, ALERT_HOURS)
+    messages = []
+    for rule, fired in alerts:
+        lines = [get_text(rule['lang_code'], f"alert_{name}", time=at, val=val) for name, at, val in fired]
+        text = get_text(
+            rule['lang_code'], "alert_msg",
+            city=rule['city_name'], country=get_flag(rule['country_code']), lines="\n".join(lines)
+        )
+        for name, _, _ in fired:
+            ALERTS_SENT.inc(condition=name)
+        names = ",".join(name for name, _, _ in fired)
+        messages.append((f"alert:{rule['chat_id']}:{start:%Y-%m-%dT%H:%M}:{names}", rule['chat_id'], text))
+    # Сообщения и новые биты состояния — одной транзакцией, иначе после сбоя оповещение потеряется или повторится
+    OUTBOX.inc(await enqueue_outbox(messages, alert_states=changes), event="queued")
+    logging.info(
+        f"Alerts checked: {len(rules)} rules over {len(cells)} cells ({len(payloads)} fetched), "
+        f"{len(alerts)} sent in {(datetime.now() - start).total_seconds():.1f}s"
+    )
+
+def is_due(sub, now):
+    # next_run_at уже наступил; ежедневная отправка — не позже часа после назначенного времени
+    if sub['interval_hours'] == 24:
+        return now - sub['next_run_at'] < timedelta(hours=1)
+    return True
+
+def get_worker_id():
+    return WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+# Партиции chat_id, которые сейчас арендует этот процесс
+owned_partitions = set()
+
+async def lease_job():
+    global owned_partitions
+    owned = await renew_leases(get_worker_id(), SHARD_PARTITIONS, LEASE_TTL)
+    if owned != owned_partitions:
+        logging.info(f"Worker {get_worker_id()} owns {len(owned)}/{SHARD_PARTITIONS} partitions")
+    # Новые партиции (после старта или падения другого воркера) сначала проверяем на пропуски,
+    # и только потом отдаём sender_job
+    gained = owned - owned_partitions
+    if gained:
+        await catch_up(gained)
+    owned_partitions = owned
+
+async def catch_up(partitions):
+    now = datetime.now()
+    await sync_registry()
+    overdue = registry.due(now - timedelta(seconds=CATCHUP_GRACE), partitions, SHARD_PARTITIONS, len(registry))
+    if not overdue:
+        return
+    rows, counts = plan_catch_up(list(map(registry.get, overdue)), now, CATCHUP_POLICY, CATCHUP_WINDOW)
+    await reschedule_subscriptions(rows)
+    await sync_registry()
+    for outcome, count in counts.items():
+        CATCHUP.inc(count, outcome=outcome)
+    logging.info(
+        f"Catch-up ({CATCHUP_POLICY}) for {len(overdue)} overdue subscriptions: {counts['skipped']} missed deliveries "
+        f"skipped, {counts['replayed']} replayed over {CATCHUP_WINDOW}s, {counts['coalesced']} merged into the next slot"
+    )
+
+async def sender_job():
+    if not owned_partitions:
+        return
+    now = datetime.now()
+    worker_id = get_worker_id()
+    try:
+        with TICK_DURATION.time():
+            # Кто просрочен — знает реестр; в БД только захватываем эти строки
+            await sync_registry()
+            due = registry.due(now, owned_partitions, SHARD_PARTITIONS, CLAIM_LIMIT)
+            claimed = await claim_subscriptions(worker_id, due, now, CLAIM_TTL) if due else []
+            subs = [sub for sub in map(registry.get, claimed) if sub is not None]
+            DELIVERIES.inc(len(subs), status="due")
+            await deliver_subscriptions(subs, now)
+    finally:
+        # Недоставленное отпускаем: его заберёт следующий тик (этот или другой воркер)
+        await release_claims(worker_id)
+
+async def prewarm_job():
+    # Подписки ближайших PREWARM_MINUTES: прогнозы и готовые тексты берём заранее и в ровном
+    # темпе, чтобы в начале часа (пик ежедневных рассылок) оставалось только отправить
+    if not owned_partitions:
+        return
     now = datetime.now()
+    subs = registry.upcoming(now, now + timedelta(minutes=PREWARM_MINUTES), owned_partitions, SHARD_PARTITIONS)
+    # Для каждой ячейки — насколько свежим прогноз должен быть сейчас, чтобы не устареть к отправке
+    need = {}
+    subs_by_cell = {}
+    for sub in subs:
+        cell = sub['cell']
+        lead = (sub['next_run_at'] - now).total_seconds()
+        max_age = FORECAST_TTL[sub['forecast_type']] - lead - PREWARM_SLACK
+        if max_age <= 0:
+            continue  # слишком рано: прогноз успеет устареть, возьмём на следующем тике
+        need[cell] = min(need.get(cell, max_age), max_age)
+        subs_by_cell.setdefault(cell, []).append(sub)
+    # Ячейки идут в порядке ближайшей отправки (подписки отсортированы по next_run_at)
+    cells = [
+        cell for cell, max_age in need.items()
+        if forecast_cache.age(cell) is None or forecast_cache.age(cell) >= max_age
+    ]
+    if not cells:
+        return
+
+    deadline = time.monotonic() + 55
+    warmed = 0
+    for i in range(0, len(cells), WEATHER_BATCH_SIZE):
+        if time.monotonic() > deadline:
+            break
+        chunk = cells[i:i + WEATHER_BATCH_SIZE]
+        started = time.monotonic()
+        try:
+            payloads = await get_forecasts({cell: need[cell] for cell in chunk})
+        except Exception as e:
+            logging.warning(f"Prewarm batch failed: {e}")
+            payloads = {}
+        for cell, payload in payloads.items():
+            for sub in subs_by_cell[cell]:
+                try:
+                    render_cached(cell, payload, sub['forecast_type'], sub['lang_code'], sub['city_name'], sub['country_code'])
+                except Exception as e:
+                    logging.warning(f"Prewarm render failed for {sub['chat_id']}: {e}")
+        PREWARMED.inc(len(payloads))
+        warmed += len(payloads)
+        await asyncio.sleep(max(0, len(chunk) / PREWARM_RATE - (time.monotonic() - started)))
+    logging.info(f"Prewarmed {warmed}/{len(cells)} forecast cells for {len(subs)} upcoming subscriptions")
+
+async def deliver_subscriptions(subs, now):
+    # Группируем по (ячейка сетки, тип прогноза); из API берём один полный прогноз на ячейку
+    groups = {}
+    missed = []
     for sub in subs:
-        should_send = False
-        last_run = datetime.fromisoformat(sub['last_run']) if isinstance(sub['last_run'], str) else sub['last_run']
-        if sub['interval_hours'] == 24:
-            if now.hour == sub['target_hour'] and (now - last_run).total_seconds() > 3600 * 20:
-                should_send = True
+        if is_due(sub, now):
+            key = (sub['cell'], sub['forecast_type'])
+            groups.setdefault(key, []).append(sub)
         else:
-            if (now - last_run).total_seconds() >= sub['interval_hours'] * 3600:
-                should_send = True
-        if should_send:
-            try:
-                lang = sub['lang_code']
-                ftype = sub['forecast_type']
-                w = await get_weather(sub['lat'], sub['lon'], ftype)
-                
-                if ftype == 'daily':
-                    daily = w['daily']
-                    curr = w['current']
-                    msg = get_text(
-                        lang, "daily_msg",
-                        city=sub['city_name'],
-                        country=get_flag(sub['country_code']),
-                        desc=get_wmo(daily['weather_code'][0], lang),
-                        t_now=curr['temperature_2m'],
-                        t_feels=curr['apparent_temperature'],
-                        t_max=daily['temperature_2m_max'][0],
-                        t_min=daily['temperature_2m_min'][0],
-                        rain=daily['precipitation_sum'][0],
-                        wind=daily['wind_speed_10m_max'][0],
-                        sunrise=daily['sunrise'][0].split('T')[1],
-                        sunset=daily['sunset'][0].split('T')[1]
-                    )
-                elif ftype == 'weekly':
-                    daily = w['daily']
-                    lines = []
-                    for i in range(7):
-                        dt = datetime.strptime(daily['time'][i], "%Y-%m-%d")
-                        short_date = dt.strftime("%d.%m")
-                        w_code = daily['weather_code'][i]
-                        t_max = daily['temperature_2m_max'][i]
-                        t_min = daily['temperature_2m_min'][i]
-                        
-                        desc_full = get_wmo(w_code, lang)
-                        emoji = desc_full.split()[0]
-                        
-                        lines.append(f"▪️ {short_date}: {emoji} <b>{t_min}°C</b> … <b>{t_max}°C</b>")
-                    
-                    msg = get_text(
-                        lang, "weekly_msg",
-                        city=sub['city_name'],
-                        country=get_flag(sub['country_code']),
-                        forecast_text="\n".join(lines)
-                    )
-                else:
-                    msg = get_text(
-                        lang, "weather_msg",
-                        city=sub['city_name'],
-                        country=get_flag(sub['country_code']),
-                        desc=get_wmo(w['weather_code'], lang),
-                        temp=w['temperature_2m'],
-                        feels=w['apparent_temperature'],
-                        wind=w['wind_speed_10m'],
-                        hum=w['relative_humidity_2m']
-                    )
-                await bot.send_message(sub['chat_id'], msg)
-                update_last_run(sub['chat_id'])
-            except Exception as e:
-                logging.error(f"Error sending to {sub['chat_id']}: {e}")
+            # Час ежедневной отправки пропущен (тик сильно опоздал) — переносим на следующий слот
+            missed.append((next_slot(24, sub['target_hour'], None, now), sub['chat_id']))
+    if missed:
+        CATCHUP.inc(len(missed), outcome="skipped")
+        await reschedule_subscriptions(missed)
+    if not groups:
+        return
+
+    cell_ttls = {}
+    groups_by_cell = {}
+    for (cell, ftype), group in groups.items():
+        cell_ttls[cell] = min(cell_ttls.get(cell, FORECAST_TTL[ftype]), FORECAST_TTL[ftype])
+        groups_by_cell.setdefault(cell, []).append((ftype, group))
+    cells = list(cell_ttls)
+
+    fetch_limit = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    # Готовые сообщения пишем в outbox пачками; отправляет их outbox_job, отдельно от скачивания прогнозов
+    messages = []
+    queued = []
+    flushes = []
+
+    def flush():
+        flushes.append(asyncio.ensure_future(enqueue_outbox(messages[:], queued[:])))
+        messages.clear()
+        queued.clear()
+
+    async def fetch_and_render(chunk):
+        async with fetch_limit:
+            payloads = await get_forecasts({cell: cell_ttls[cell] for cell in chunk})
+        for cell, payload in payloads.items():
+            for ftype, group in groups_by_cell[cell]:
+                for sub in group:
+                    try:
+                        msg = render_cached(cell, payload, ftype, sub['lang_code'], sub['city_name'], sub['country_code'])
+                    except Exception as e:
+                        logging.error(f"Error rendering for {sub['chat_id']}: {e}")
+                        DELIVERIES.inc(status="failed")
+                        continue
+                    # Ключ — слот расписания: один и тот же слот не попадёт в outbox дважды
+                    messages.append((f"report:{sub['chat_id']}:{sub['next_run_at'].isoformat()}", sub['chat_id'], msg))
+                    queued.append(delivered_row(sub))
+                    if len(messages) >= DB_FLUSH_SIZE:
+                        flush()
+
+    await asyncio.gather(*[
+        fetch_and_render(cells[i:i + WEATHER_BATCH_SIZE])
+        for i in range(0, len(cells), WEATHER_BATCH_SIZE)
+    ])
+    flush()
+    added = sum(await asyncio.gather(*flushes))
+    OUTBOX.inc(added, event="queued")
+    logging.info(f"Sender tick done in {(datetime.now() - now).total_seconds():.1f}s, {added} messages queued")
+
+async def outbox_job(queue: SendQueue):
+    # Потребитель outbox: забирает готовые сообщения своих партиций, отправляет через SendQueue
+    # и подтверждает итог каждой пачки. После падения незавершённые строки заберут снова по истечении CLAIM_TTL
+    worker_id = get_worker_id()
+    while owned_partitions:
+        rows, expired = await claim_outbox(
+            worker_id, owned_partitions, SHARD_PARTITIONS, OUTBOX_BATCH, CLAIM_TTL, OUTBOX_TTL, SEND_FAIL_LIMIT
+        )
+        if expired:
+            DELIVERIES.inc(expired, status="failed")
+            OUTBOX.inc(expired, event="expired")
+            logging.info(f"Outbox: {expired} messages older than {OUTBOX_TTL}s expired unsent")
+        if not rows:
+            return
+        sent = []
+        retry = []
+        failed = []
+        migrated = []
 
-async def main():
-    init_db()
+        def on_sent(row):
+            DELIVERIES.inc(status="delivered")
+            sent.append((row['id'], row['chat_id']))
+
+        def on_error(row, error):
+            kind = classify_error(error)
+            SEND_FAILURES.inc(kind=kind)
+            if kind == 'migrated':
+                migrated.append((error.migrate_to_chat_id, row['id'], row['chat_id']))
+            elif kind != 'transient':
+                DELIVERIES.inc(status="failed")
+                failed.append((row['id'], row['chat_id'], True))
+            elif time.time() - row['created_at'] >= OUTBOX_TTL:
+                # Прогноз устарел — повторять дальше нет смысла
+                DELIVERIES.inc(status="failed")
+                OUTBOX.inc(event="expired")
+                failed.append((row['id'], row['chat_id'], False))
+            else:
+                OUTBOX.inc(event="retried")
+                delay = min(SEND_RETRY_BASE * 2 ** row['attempts'], SEND_RETRY_MAX)
+                retry.append((time.time() + delay, row['id']))
+
+        for row in rows:
+            queue.put(row['chat_id'], row['text'], on_sent=partial(on_sent, row), on_error=partial(on_error, row))
+        await queue.join()
+        await settle_outbox(sent, retry, failed, migrated, SEND_FAIL_LIMIT)
+        if failed or migrated or retry:
+            logging.info(f"Outbox batch: {len(sent)} sent, {len(retry)} to retry, {len(failed)} failed, {len(migrated)} migrated")
+        if len(rows) < OUTBOX_BATCH:
+            return
+
+async def run_webhook(dp: Dispatcher, bot: Bot, stop: asyncio.Event):
+    # Секрет не задан — генерируем на каждый запуск: set_webhook ниже всё равно передаёт его Telegram
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(dp, bot, WEBHOOK_PATH, secret=secret, max_inflight=WEBHOOK_MAX_INFLIGHT)
+    await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=True
+    )
+    try:
+        await stop.wait()
+    finally:
+        await server.stop()
+
+async def main(role='all', metrics_port=None):
+    # Без публичного адреса Telegram отклонит set_webhook уже после запуска сервера — проверяем сразу
+    if role != 'delivery' and BOT_MODE == 'webhook' and not WEBHOOK_URL.startswith('https://'):
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL set to the bot's public https:// address")
+    await init_db(DB_FILE)
+    await purge_geocode(GEOCODE_DB_TTL)
+    await load_registry()
+    global gazetteer
+    gazetteer = open_gazetteer(GAZETTEER_FILE)
     bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+    fsm_storage = SQLiteStorage(ttl=FSM_TTL)
+    dp = Dispatcher(storage=fsm_storage)
     dp.include_router(router)
+    for observer in [router.message, router.callback_query, router.inline_query, router.chat_member, router.my_chat_member]:
+        observer.middleware(HandlerMetricsMiddleware())
 
+    get_http_session()
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(sender_job, "interval", minutes=1, kwargs={"bot": bot}) 
-    scheduler.start()
+    send_queue = None
 
     logging.basicConfig(level=logging.INFO)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    metrics_port = METRICS_PORT if metrics_port is None else metrics_port
+    metrics_runner = await start_metrics_server(METRICS_HOST, metrics_port) if metrics_port else None
+    if role in ['all', 'bot']:
+        scheduler.add_job(fsm_storage.purge, "interval", minutes=10, max_instances=1, coalesce=True)
+        scheduler.add_job(purge_tombstones, "interval", hours=1, args=[TOMBSTONE_TTL], max_instances=1, coalesce=True)
+        scheduler.add_job(purge_outbox, "interval", hours=1, args=[OUTBOX_RETENTION], max_instances=1, coalesce=True)
+    scheduler.add_job(sync_registry, "interval", seconds=REGISTRY_SYNC, max_instances=1, coalesce=True)
+    # Роли: all — всё в одном процессе, bot — только обновления, delivery — только рассылка
+    if role in ['all', 'delivery']:
+        send_queue = SendQueue(
+            bot, workers=SEND_WORKERS,
+            global_rate=TELEGRAM_GLOBAL_RATE, group_rate=TELEGRAM_GROUP_RATE
+        )
+        send_queue.start()
+        CallbackMetric("weather_send_queue_depth", "Messages waiting in the send queue", lambda: {(): send_queue.depth()})
+        await lease_job()
+        scheduler.add_job(lease_job, "interval", seconds=max(LEASE_TTL // 3, 1), max_instances=1, coalesce=True)
+        # Производители (рассылка, оповещения) пишут в outbox, outbox_job отправляет независимо от них
+        scheduler.add_job(sender_job, "interval", minutes=1, max_instances=1, coalesce=True)
+        scheduler.add_job(alerts_job, "interval", minutes=ALERT_INTERVAL, max_instances=1, coalesce=True)
+        scheduler.add_job(
+            outbox_job, "interval", seconds=OUTBOX_POLL,
+            kwargs={"queue": send_queue}, max_instances=1, coalesce=True
+        )
+        if PREWARM_MINUTES > 0:
+            scheduler.add_job(prewarm_job, "interval", minutes=1, max_instances=1, coalesce=True)
+    scheduler.start()
 
-if __name__ == "__main__":
+    # SIGTERM (docker stop, systemd, остановка воркеров родителем) — штатная остановка с очисткой ниже.
+    # В режиме polling aiogram ставит свой обработчик с тем же результатом
+    stop = asyncio.Event()
+    if sys.platform != 'win32':
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+
+    try:
+        if role == 'delivery':
+            await stop.wait()
+        elif BOT_MODE == 'webhook':
+            await run_webhook(dp, bot, stop)
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        scheduler.shutdown(wait=False)
+        if send_queue is not None:
+            await send_queue.stop()
+            # Захваты, аренды и outbox сразу отдаём: после рестарта воркер приходит под новым
+            # именем (hostname-pid) и иначе ждал бы LEASE_TTL / CLAIM_TTL
+            await release_outbox(get_worker_id())
+            await release_claims(get_worker_id())
+            await release_leases(get_worker_id())
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_http_session()
+        await bot.session.close()
+        await close_db()
+        if gazetteer is not None:
+            gazetteer.close()
+
+def run_process(role, metrics_port=None, worker_index=None):
+    global WORKER_ID
+    # Порождённые воркеры наследуют WORKER_ID из окружения; владелец аренд и захватов должен быть у каждого свой
+    if WORKER_ID and worker_index is not None:
+        WORKER_ID = f"{WORKER_ID}-{worker_index}"
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main(role, metrics_port))
+
+if __name__ == "__main__":
+    # DELIVERY_PROCESSES > 0: рассылка уходит в отдельные процессы, этот обрабатывает обновления.
+    # Метрики воркера i доступны на METRICS_PORT + i.
+    workers = [
+        multiprocessing.Process(
+            target=run_process, args=('delivery', METRICS_PORT + i if METRICS_PORT else 0, i), daemon=True
+        )
+        for i in range(1, DELIVERY_PROCESSES + 1)
+    ]
+    if workers:
+        # Миграции схемы — один раз здесь, до запуска воркеров
+        asyncio.run(init_db(DB_FILE))
+        asyncio.run(close_db())
+    for worker in workers:
+        worker.start()
+    try:
+        run_process('bot' if workers else BOT_ROLE)
+    finally:
+        # Воркерам — SIGTERM и время отпустить аренды и захваты
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(timeout=30)
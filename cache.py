@@ -0,0 +1,199 @@
+# cache.py
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # LRU-кэш с временем жизни записей и счётчиками попаданий
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self.data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ForecastCache:
+    # Кэш прогнозов по ячейке сетки. Свежесть проверяется при чтении: каждый режим
+    # передаёт свой TTL. Вытеснение по бюджету памяти, один запрос к API на ключ
+    # (single-flight) и отдача устаревших данных с фоновым обновлением (stale-while-revalidate).
+    def __init__(self, max_bytes, stale_ttl=0):
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.data = OrderedDict()  # key -> (fetched_at, size, value)
+        self.bytes = 0
+        self.inflight = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._background = set()
+
+    def _lookup(self, key, ttl):
+        # -> (value, fresh) или None, если записи нет или она слишком старая для этого TTL.
+        # Старые записи не удаляем: для режима с длинным TTL они ещё годятся.
+        item = self.data.get(key)
+        if item is None:
+            return None
+        fetched_at, _, value = item
+        age = time.monotonic() - fetched_at
+        if age < ttl:
+            self.data.move_to_end(key)
+            return value, True
+        if age < ttl + self.stale_ttl:
+            return value, False
+        return None
+
+    def _remove(self, key):
+        item = self.data.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def set(self, key, value):
+        size = len(json.dumps(value, separators=(",", ":")))
+        self._remove(key)
+        self.data[key] = (time.monotonic(), size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.data) > 1:
+            old_key, (_, old_size, _) = self.data.popitem(last=False)
+            self.bytes -= old_size
+
+    def get(self, key, ttl):
+        found = self._lookup(key, ttl)
+        if found is not None and found[1]:
+            self.hits += 1
+            return found[0]
+        self.misses += 1
+        return None
+
+    async def get_or_fetch(self, key, fetch, ttl):
+        found = self._lookup(key, ttl)
+        if found is not None:
+            value, fresh = found
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                self._revalidate(key, fetch)
+            return value
+        self.misses += 1
+        return await self._load(key, fetch)
+
+    async def get_many(self, keys, fetch_many):
+        # keys: {key: ttl}; fetch_many(keys) -> {key: value}; возвращает только найденные ключи
+        result = {}
+        waiting = {}
+        to_fetch = []
+        for key, ttl in keys.items():
+            value = self.get(key, ttl)
+            if value is not None:
+                result[key] = value
+            elif key in self.inflight:
+                waiting[key] = self.inflight[key]
+            else:
+                to_fetch.append(key)
+
+        if to_fetch:
+            futures = {key: self._start_flight(key) for key in to_fetch}
+            try:
+                fetched = await fetch_many(to_fetch)
+            except BaseException as e:
+                for key in to_fetch:
+                    self._finish_flight(key, futures[key], error=e)
+                raise
+            for key in to_fetch:
+                value = fetched.get(key)
+                if value is not None:
+                    self.set(key, value)
+                    result[key] = value
+                self._finish_flight(key, futures[key], value=value)
+
+        for key, future in waiting.items():
+            try:
+                value = await asyncio.shield(future)
+            except Exception:
+                continue
+            if value is not None:
+                result[key] = value
+        return result
+
+    def _start_flight(self, key):
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        return future
+
+    def _finish_flight(self, key, future, value=None, error=None):
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if error is not None:
+            if isinstance(error, asyncio.CancelledError):
+                error = RuntimeError("forecast fetch was cancelled")
+            future.set_exception(error)
+            future.exception()  # не ругаться, если ошибку никто не ждал
+        else:
+            future.set_result(value)
+
+    async def _load(self, key, fetch):
+        future = self.inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self._start_flight(key)
+        try:
+            value = await fetch()
+        except BaseException as e:
+            self._finish_flight(key, future, error=e)
+            raise
+        if value is not None:
+            self.set(key, value)
+        self._finish_flight(key, future, value=value)
+        return value
+
+    def _revalidate(self, key, fetch):
+        if key in self.inflight:
+            return
+        task = asyncio.create_task(self._load(key, fetch))
+        self._background.add(task)
+        task.add_done_callback(self._revalidated)
+
+    def _revalidated(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f"Forecast revalidation failed: {task.exception()}")
+
+    def age(self, key):
+        # Возраст записи в секундах (None — записи нет); счётчики не трогает
+        item = self.data.get(key)
+        return None if item is None else time.monotonic() - item[0]
+
+    def __len__(self):
+        return len(self.data)
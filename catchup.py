@@ -0,0 +1,43 @@
+# catchup.py
+from datetime import timedelta
+
+from database import missed_slots, next_slot
+
+# Что делать с отправками, пропущенными пока бот не работал:
+#   drop     — пропустить, подписка продолжает со своего следующего слота
+#   coalesce — одно сообщение вместо всех пропущенных; если следующий слот и так попадает в окно, он и есть это сообщение
+#   replay   — одно догоняющее сообщение каждой пропустившей подписке, даже если её слот скоро
+# Догоняющие сообщения равномерно распределяются по окну, а не уходят всплеском в первый тик.
+# Повторять каждый пропущенный слот нет смысла: прогноз всё равно будет текущий.
+POLICIES = ('drop', 'coalesce', 'replay')
+
+
+def plan(subs, now, policy, window):
+    # subs — просроченные подписки, самые давние первыми.
+    # -> ([(next_run_at, chat_id)], {исход: число}), исходы: skipped — слоты, которые не будут отправлены,
+    #    replayed — назначенные догоняющие сообщения, coalesced — подписки, объединённые со следующим слотом
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown catch-up policy {policy!r}, expected one of {', '.join(POLICIES)}")
+    window = timedelta(seconds=window)
+    rows = []
+    counts = {'skipped': 0, 'replayed': 0, 'coalesced': 0}
+    replay = []
+    for sub in subs:
+        regular = next_slot(sub['interval_hours'], sub['target_hour'], sub['phase_minutes'], now)
+        if regular <= now:
+            continue  # час ежедневной отправки ещё идёт — это обычная отправка, а не пропуск
+        missed = missed_slots(sub['interval_hours'], sub['next_run_at'], now)
+        if policy == 'drop':
+            rows.append((regular, sub['chat_id']))
+            counts['skipped'] += missed
+        elif policy == 'coalesce' and regular <= now + window:
+            rows.append((regular, sub['chat_id']))
+            counts['skipped'] += missed
+            counts['coalesced'] += 1
+        else:
+            replay.append(sub)
+            counts['skipped'] += missed - 1
+    for i, sub in enumerate(replay):
+        rows.append((now + window * i / len(replay), sub['chat_id']))
+    counts['replayed'] = len(replay)
+    return rows, counts
@@ -0,0 +1,745 @@
+# database.py
+import asyncio
+import json
+import math
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from metrics import DB_LATENCY
+
+DB_FILE = None
+
+# Одно долгоживущее соединение на процесс (WAL, без fsync на каждый коммит).
+# Вся работа с ним идёт в отдельном потоке, чтобы запись на диск не блокировала event loop.
+_conn = None
+_executor = None
+
+SQL_SAVE_SUBSCRIPTION = """
+    INSERT OR REPLACE INTO subscriptions
+    (chat_id, chat_type, lang_code, city_name, country_code, lat, lon, forecast_type, interval_hours, target_hour,
+     phase_minutes, last_run, next_run_at, version)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    RETURNING *
+"""
+SQL_GET_ALL = "SELECT * FROM subscriptions"
+SQL_DELETE = "DELETE FROM subscriptions WHERE chat_id = ?"
+# Каждая запись в subscriptions получает номер версии из общего счётчика (транзакции записи идут
+# строго по очереди), удаления оставляют надгробие — так процессы догоняют чужие изменения
+SQL_NEXT_VERSION = "UPDATE counters SET value = value + 1 WHERE name = 'subscriptions' RETURNING value"
+SQL_TOMBSTONE = "INSERT OR REPLACE INTO subscription_tombstones (chat_id, version, deleted_at) VALUES (?, ?, ?)"
+SQL_CHANGED_SUBSCRIPTIONS = "SELECT * FROM subscriptions WHERE version > ?"
+SQL_CHANGED_TOMBSTONES = "SELECT chat_id, version FROM subscription_tombstones WHERE version > ?"
+# Недоставляемые подписки: next_run_at = NULL убирает строку из выборок по индексу
+SQL_DEACTIVATE = """
+    UPDATE subscriptions SET active = 0, next_run_at = NULL, claimed_by = NULL, claim_until = NULL, version = ?
+    WHERE chat_id = ?
+"""
+SQL_REACTIVATE = """
+    UPDATE subscriptions SET active = 1, fail_count = 0, next_run_at = ?, version = ?
+    WHERE chat_id = ? AND active = 0
+"""
+# Группа стала супергруппой: подписка переезжает на новый chat_id
+SQL_MIGRATE_CHAT = """
+    UPDATE OR REPLACE subscriptions SET chat_id = ?, chat_type = 'supergroup', claimed_by = NULL, claim_until = NULL,
+        version = ?
+    WHERE chat_id = ?
+"""
+# Сообщение ушло в outbox: расписание сдвигаем сразу, fail_count — только по итогам отправки
+SQL_MARK_QUEUED = """
+    UPDATE subscriptions SET last_run = ?, next_run_at = ?, claimed_by = NULL, claim_until = NULL, version = ?
+    WHERE chat_id = ?
+"""
+SQL_RESET_FAILURES = "UPDATE subscriptions SET fail_count = 0, version = ? WHERE chat_id = ? AND fail_count > 0"
+SQL_COUNT_FAILURE = "UPDATE subscriptions SET fail_count = fail_count + 1, version = ? WHERE chat_id = ?"
+SQL_DEACTIVATE_FAILING = """
+    UPDATE subscriptions SET active = 0, next_run_at = NULL, claimed_by = NULL, claim_until = NULL, version = ?
+    WHERE chat_id = ? AND active = 1 AND fail_count >= ?
+"""
+SQL_RESCHEDULE = """
+    UPDATE subscriptions SET next_run_at = ?, claimed_by = NULL, claim_until = NULL, version = ? WHERE chat_id = ?
+"""
+SQL_SET_PHASE = "UPDATE subscriptions SET phase_minutes = ?, next_run_at = ?, version = ? WHERE chat_id = ?"
+# Захват подписок, которые реестр процесса считает просроченными: строку берёт ровно один воркер.
+# Условие на next_run_at отсекает то, что уже отправил другой воркер, а реестр ещё не знает
+SQL_CLAIM = """
+    UPDATE subscriptions SET claimed_by = ?, claim_until = ?
+    WHERE chat_id IN ({placeholders}) AND next_run_at <= ? AND active = 1
+      AND (claim_until IS NULL OR claim_until < ?)
+    RETURNING chat_id
+"""
+CLAIM_CHUNK = 500
+SQL_RELEASE_CLAIMS = "UPDATE subscriptions SET claimed_by = NULL, claim_until = NULL WHERE claimed_by = ?"
+# Оповещения о погоде: пороги (NULL — условие выключено) и биты уже сработавших условий
+SQL_SAVE_ALERT_RULE = """
+    INSERT OR REPLACE INTO alert_rules
+    (chat_id, chat_type, lang_code, city_name, country_code, lat, lon, rain_mm, frost_c, wind_ms, state)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+    RETURNING *
+"""
+SQL_GET_ALERT_RULE = "SELECT * FROM alert_rules WHERE chat_id = ?"
+SQL_DELETE_ALERT_RULE = "DELETE FROM alert_rules WHERE chat_id = ?"
+SQL_TOGGLE_ALERT = """
+    UPDATE alert_rules SET {column} = CASE WHEN {column} IS NULL THEN ? ELSE NULL END, state = state & ~?
+    WHERE chat_id = ?
+    RETURNING *
+"""
+SQL_ALERT_RULES = """
+    SELECT * FROM alert_rules
+    WHERE ((chat_id % ?) + ?) % ? IN ({placeholders})
+      AND active = 1 AND (rain_mm IS NOT NULL OR frost_c IS NOT NULL OR wind_ms IS NOT NULL)
+"""
+SQL_SET_ALERT_STATE = "UPDATE alert_rules SET state = ? WHERE chat_id = ?"
+# Чат заблокировал бота / сменил id — правила оповещений следуют за подпиской
+SQL_SET_ALERT_ACTIVE = "UPDATE alert_rules SET active = ? WHERE chat_id = ? AND active != ?"
+SQL_MIGRATE_ALERT_RULE = "UPDATE OR REPLACE alert_rules SET chat_id = ?, chat_type = 'supergroup' WHERE chat_id = ?"
+# Outbox: готовые сообщения ждут отправки здесь. dedup_key не даёт поставить одно и то же дважды,
+# отправленные и брошенные строки (done_at) хранятся до очистки ради дедупликации
+SQL_ENQUEUE = "INSERT OR IGNORE INTO outbox (dedup_key, chat_id, text, created_at, not_before) VALUES (?, ?, ?, ?, ?)"
+SQL_CLAIM_OUTBOX = """
+    UPDATE outbox SET claimed_by = ?, claim_until = ?
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE done_at IS NULL AND not_before <= ? AND (claim_until IS NULL OR claim_until < ?)
+          AND ((chat_id % ?) + ?) % ? IN ({placeholders})
+        ORDER BY id LIMIT ?
+    )
+    RETURNING id, chat_id, text, attempts, created_at
+"""
+# Не отправленное вовремя устаревает ещё до попытки: после долгого простоя старые прогнозы не рассылаем
+SQL_EXPIRE_OUTBOX = """
+    UPDATE outbox SET status = 'expired', done_at = ?, claimed_by = NULL, claim_until = NULL
+    WHERE done_at IS NULL AND created_at < ? AND (claim_until IS NULL OR claim_until < ?)
+    RETURNING chat_id, attempts
+"""
+SQL_OUTBOX_DONE = "UPDATE outbox SET status = ?, done_at = ?, claimed_by = NULL, claim_until = NULL WHERE id = ?"
+SQL_OUTBOX_RETRY = """
+    UPDATE outbox SET attempts = attempts + 1, not_before = ?, claimed_by = NULL, claim_until = NULL WHERE id = ?
+"""
+SQL_OUTBOX_RETARGET = "UPDATE outbox SET chat_id = ?, claimed_by = NULL, claim_until = NULL WHERE id = ?"
+SQL_RELEASE_OUTBOX = "UPDATE outbox SET claimed_by = NULL, claim_until = NULL WHERE claimed_by = ? AND done_at IS NULL"
+ALERT_COLUMNS = ('rain_mm', 'frost_c', 'wind_ms')
+SQL_GET_GEOCODE = "SELECT results, created_at FROM geocode_cache WHERE query = ? AND lang = ?"
+SQL_SAVE_GEOCODE = "INSERT OR REPLACE INTO geocode_cache (query, lang, results, created_at) VALUES (?, ?, ?, ?)"
+
+
+def connect(path=None):
+    global _conn, DB_FILE
+    if path:
+        DB_FILE = path
+    if _conn is None:
+        _conn = sqlite3.connect(DB_FILE, cached_statements=256)
+        _conn.row_factory = sqlite3.Row
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute("PRAGMA cache_size=-16000")
+        _conn.execute("PRAGMA temp_store=MEMORY")
+        _conn.execute("PRAGMA busy_timeout=5000")
+    return _conn
+
+def get_conn():
+    if _conn is None:
+        if DB_FILE is None:
+            raise RuntimeError("Database is not initialized, call init_db() first")
+        return connect()
+    return _conn
+
+def _close():
+    global _conn
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+    return _executor
+
+async def run(fn, *args):
+    # Очередь запросов к БД: один поток, задачи выполняются строго по порядку
+    loop = asyncio.get_running_loop()
+    with DB_LATENCY.time(op=fn.__name__.lstrip('_')):
+        return await loop.run_in_executor(_get_executor(), fn, *args)
+
+async def close():
+    global _executor
+    if _executor is not None:
+        await run(_close)
+        _executor.shutdown(wait=True)
+        _executor = None
+
+@contextmanager
+def _write_tx():
+    # BEGIN IMMEDIATE: сразу берём блокировку записи, чтобы другие процессы не вклинились
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+def _add_column(conn, table, column, decl):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+def _init_db(path=None):
+    connect(path)
+    # Схема и миграции — под блокировкой записи: несколько процессов, стартующих разом, иначе
+    # одновременно увидят, что колонки нет, и второй ALTER TABLE упадёт
+    with _write_tx() as conn:
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id INTEGER PRIMARY KEY,
+            chat_type TEXT,
+            lang_code TEXT,
+            city_name TEXT,
+            country_code TEXT,
+            lat REAL,
+            lon REAL,
+            forecast_type TEXT DEFAULT 'current',
+            interval_hours INTEGER,
+            target_hour INTEGER,
+            last_run TIMESTAMP,
+            next_run_at TIMESTAMP,
+            phase_minutes INTEGER,
+            active INTEGER DEFAULT 1,
+            fail_count INTEGER DEFAULT 0,
+            version INTEGER DEFAULT 0,
+            claimed_by TEXT,
+            claim_until REAL
+        )
+        """)
+        # Миграция старых баз: заполняем next_run_at по last_run
+        if _add_column(conn, "subscriptions", "next_run_at", "TIMESTAMP"):
+            rows = conn.execute("SELECT chat_id, interval_hours, target_hour, last_run FROM subscriptions").fetchall()
+            conn.executemany(
+                "UPDATE subscriptions SET next_run_at = ? WHERE chat_id = ?",
+                [(compute_next_run(interval, hour, parse_ts(last_run)), chat_id) for chat_id, interval, hour, last_run in rows]
+            )
+        _add_column(conn, "subscriptions", "claimed_by", "TEXT")
+        # Фаза интервальных подписок; старым строкам — от chat_id, выровняются после следующей отправки
+        if _add_column(conn, "subscriptions", "phase_minutes", "INTEGER"):
+            rows = conn.execute("SELECT chat_id, interval_hours FROM subscriptions WHERE interval_hours != 24").fetchall()
+            conn.executemany(
+                "UPDATE subscriptions SET phase_minutes = ? WHERE chat_id = ?",
+                [(default_phase(chat_id, interval), chat_id) for chat_id, interval in rows]
+            )
+        _add_column(conn, "subscriptions", "claim_until", "REAL")
+        _add_column(conn, "subscriptions", "active", "INTEGER DEFAULT 1")
+        _add_column(conn, "subscriptions", "fail_count", "INTEGER DEFAULT 0")
+        _add_column(conn, "subscriptions", "version", "INTEGER DEFAULT 0")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_next_run ON subscriptions(next_run_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_version ON subscriptions(version)")
+        # Версии изменений подписок для синхронизации реестров в памяти между процессами
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+        conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('subscriptions', 0)")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS subscription_tombstones (
+            chat_id INTEGER PRIMARY KEY,
+            version INTEGER,
+            deleted_at REAL
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_subscription_tombstones_version ON subscription_tombstones(version)")
+        # Шардирование доставки: аренда партиций chat_id и пульс живых воркеров
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS shard_leases (
+            partition INTEGER PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
+        )
+        """)
+        # Состояния FSM диалогов (компактный JSON, старые вычищаются по updated_at)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS worker_heartbeats (
+            worker_id TEXT PRIMARY KEY,
+            seen_at REAL
+        )
+        """)
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS alert_rules (
+            chat_id INTEGER PRIMARY KEY,
+            chat_type TEXT,
+            lang_code TEXT,
+            city_name TEXT,
+            country_code TEXT,
+            lat REAL,
+            lon REAL,
+            rain_mm REAL,
+            frost_c REAL,
+            wind_ms REAL,
+            state INTEGER DEFAULT 0,
+            active INTEGER DEFAULT 1
+        )
+        """)
+        _add_column(conn, "alert_rules", "active", "INTEGER DEFAULT 1")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dedup_key TEXT UNIQUE,
+            chat_id INTEGER,
+            text TEXT,
+            created_at REAL,
+            not_before REAL,
+            attempts INTEGER DEFAULT 0,
+            claimed_by TEXT,
+            claim_until REAL,
+            status TEXT,
+            done_at REAL
+        )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(not_before) WHERE done_at IS NULL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_done ON outbox(done_at) WHERE done_at IS NOT NULL")
+        # Кэш геокодера: переживает рестарты
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            query TEXT,
+            lang TEXT,
+            results TEXT,
+            created_at REAL,
+            PRIMARY KEY (query, lang)
+        )
+        """)
+
+def parse_ts(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+# Отсчёт фаз интервальных подписок: отправки идут в минуты, где (минут от якоря) % период == фаза.
+# Периоды 2 и 12 часов делят сутки, поэтому слоты одинаковы каждый день.
+PHASE_ANCHOR = datetime(2000, 1, 1)
+
+def default_phase(chat_id, interval_hours):
+    # Стабильная фаза от chat_id: подписки расходятся по всему интервалу, а не по минуте регистрации
+    return zlib.crc32(str(chat_id).encode()) % (interval_hours * 60)
+
+def phase_slots(interval_hours, phase):
+    # Минуты суток, в которые срабатывает подписка с этой фазой
+    period = interval_hours * 60
+    return [(phase + k * period) % 1440 for k in range(max(1440 // period, 1))]
+
+def compute_next_run(interval_hours, target_hour, last_run, phase=None):
+    if interval_hours != 24:
+        if phase is None:
+            return last_run + timedelta(hours=interval_hours)
+        # Ближайший слот своей фазы не раньше чем через пол-интервала после прошлой отправки:
+        # сдвинутая отправка за один цикл возвращается на свою фазу
+        earliest = last_run + timedelta(hours=interval_hours / 2)
+        minutes = -(-(earliest - PHASE_ANCHOR) // timedelta(minutes=1))
+        minutes += (phase - minutes) % (interval_hours * 60)
+        return PHASE_ANCHOR + timedelta(minutes=minutes)
+    # Ежедневная: ближайший target_hour:00, но не раньше чем через 20 часов после прошлой отправки
+    earliest = last_run + timedelta(hours=20)
+    candidate = earliest.replace(hour=target_hour, minute=0, second=0, microsecond=0)
+    if candidate + timedelta(hours=1) <= earliest:
+        candidate += timedelta(days=1)
+    return max(candidate, earliest)
+
+def next_slot(interval_hours, target_hour, phase, now):
+    # Ближайшее время по расписанию начиная с now (текущий час ежедневной подписки ещё считается её слотом)
+    if interval_hours == 24:
+        return compute_next_run(24, target_hour, now - timedelta(hours=20))
+    if phase is None:
+        return now
+    return compute_next_run(interval_hours, None, now - timedelta(hours=interval_hours / 2), phase)
+
+def missed_slots(interval_hours, next_run_at, now):
+    # Сколько отправок по расписанию пришлось на [next_run_at, now)
+    if next_run_at >= now:
+        return 0
+    return 1 + int((now - next_run_at) / timedelta(hours=interval_hours))
+
+def _save_subscription(data):
+    ftype = data.get('forecast_type', 'current')
+    # Первая отправка — в ближайший слот расписания: новая подписка не бывает «просроченной»
+    # и не попадает в учёт пропусков (catchup.py)
+    now = datetime.now()
+    phase = default_phase(data['chat_id'], data['interval']) if data['interval'] != 24 else None
+    with _write_tx() as conn:
+        return conn.execute(SQL_SAVE_SUBSCRIPTION, (
+            data['chat_id'], data['chat_type'], data['lang'],
+            data['city'], data['country'], data['lat'], data['lon'],
+            ftype,
+            data['interval'], data.get('target_hour'), phase,
+            now, next_slot(data['interval'], data.get('target_hour'), phase, now),
+            _next_version(conn)
+        )).fetchone()
+
+def _next_version(conn):
+    return conn.execute(SQL_NEXT_VERSION).fetchone()[0]
+
+def _get_subscription_changes(since):
+    # -> (строки с version > since, [(chat_id, version)] удалённых, текущая версия); один снимок чтения
+    conn = get_conn()
+    conn.execute("BEGIN")
+    try:
+        version = conn.execute("SELECT value FROM counters WHERE name = 'subscriptions'").fetchone()[0]
+        rows = conn.execute(SQL_CHANGED_SUBSCRIPTIONS, (since,)).fetchall()
+        tombstones = [tuple(row) for row in conn.execute(SQL_CHANGED_TOMBSTONES, (since,))]
+    finally:
+        conn.commit()
+    return rows, tombstones, version
+
+def _purge_tombstones(max_age):
+    with get_conn() as conn:
+        conn.execute("DELETE FROM subscription_tombstones WHERE deleted_at < ?", (time.time() - max_age,))
+
+def _get_all_subscriptions():
+    return get_conn().execute(SQL_GET_ALL).fetchall()
+
+def _renew_leases(worker_id, partitions, ttl):
+    # Продлевает свои партиции, добирает свободные до справедливой доли и отдаёт лишние.
+    # Возвращает множество партиций, которыми воркер владеет.
+    now = time.time()
+    with _write_tx() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO shard_leases (partition, owner, expires_at) VALUES (?, NULL, 0)",
+            [(p,) for p in range(partitions)]
+        )
+        conn.execute("INSERT OR REPLACE INTO worker_heartbeats (worker_id, seen_at) VALUES (?, ?)", (worker_id, now))
+        conn.execute("DELETE FROM worker_heartbeats WHERE seen_at < ?", (now - ttl,))
+        live = conn.execute("SELECT COUNT(*) FROM worker_heartbeats").fetchone()[0]
+        fair_share = math.ceil(partitions / max(live, 1))
+
+        conn.execute("UPDATE shard_leases SET expires_at = ? WHERE owner = ? AND partition < ?", (now + ttl, worker_id, partitions))
+        owned = [row[0] for row in conn.execute(
+            "SELECT partition FROM shard_leases WHERE owner = ? AND partition < ? ORDER BY partition", (worker_id, partitions)
+        )]
+        if len(owned) > fair_share:
+            extra = owned[fair_share:]
+            conn.executemany("UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE partition = ?", [(p,) for p in extra])
+            owned = owned[:fair_share]
+        elif len(owned) < fair_share:
+            claimed = conn.execute("""
+                UPDATE shard_leases SET owner = ?, expires_at = ?
+                WHERE partition IN (
+                    SELECT partition FROM shard_leases
+                    WHERE partition < ? AND (owner IS NULL OR expires_at < ?)
+                    ORDER BY partition LIMIT ?
+                )
+                RETURNING partition
+            """, (worker_id, now + ttl, partitions, now, fair_share - len(owned))).fetchall()
+            owned += [row[0] for row in claimed]
+    return set(owned)
+
+def _claim_subscriptions(worker_id, chat_ids, now, claim_ttl):
+    # -> chat_id, которые удалось захватить
+    ts = time.time()
+    claimed = []
+    with _write_tx() as conn:
+        for i in range(0, len(chat_ids), CLAIM_CHUNK):
+            chunk = chat_ids[i:i + CLAIM_CHUNK]
+            sql = SQL_CLAIM.format(placeholders=",".join("?" * len(chunk)))
+            claimed += [row[0] for row in conn.execute(sql, (worker_id, ts + claim_ttl, *chunk, now, ts))]
+    return claimed
+
+def _release_claims(worker_id):
+    with get_conn() as conn:
+        conn.execute(SQL_RELEASE_CLAIMS, (worker_id,))
+
+def _release_leases(worker_id):
+    # Штатная остановка: партиции и пульс сразу освобождаем, не дожидаясь LEASE_TTL
+    with _write_tx() as conn:
+        conn.execute("UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE owner = ?", (worker_id,))
+        conn.execute("DELETE FROM worker_heartbeats WHERE worker_id = ?", (worker_id,))
+
+def _delete_subscription(chat_id):
+    with _write_tx() as conn:
+        conn.execute(SQL_DELETE, (chat_id,))
+        conn.execute(SQL_TOMBSTONE, (chat_id, _next_version(conn), time.time()))
+
+def delivered_row(sub, when=None):
+    # Строка для enqueue_outbox: (last_run, next_run_at, chat_id)
+    when = when or datetime.now()
+    base = when
+    if sub['interval_hours'] == 24:
+        # Ежедневные считаем от своего слота: догоняющая отправка днём не сдвигает завтрашнюю
+        base = when.replace(hour=sub['target_hour'], minute=0, second=0, microsecond=0)
+        if base > when:
+            base -= timedelta(days=1)
+    next_run = compute_next_run(sub['interval_hours'], sub['target_hour'], base, sub['phase_minutes'])
+    return (when, next_run, sub['chat_id'])
+
+def _set_active(chat_id, active):
+    # -> изменилось ли что-нибудь (подписка или правило оповещений)
+    with _write_tx() as conn:
+        flag = int(bool(active))
+        alerts = conn.execute(SQL_SET_ALERT_ACTIVE, (flag, chat_id, flag)).rowcount
+        if active:
+            return conn.execute(SQL_REACTIVATE, (datetime.now(), _next_version(conn), chat_id)).rowcount + alerts > 0
+        return conn.execute(SQL_DEACTIVATE, (_next_version(conn), chat_id)).rowcount + alerts > 0
+
+def _set_phases(rows):
+    # rows: (phase_minutes, next_run_at, chat_id)
+    with _write_tx() as conn:
+        version = _next_version(conn)
+        conn.executemany(SQL_SET_PHASE, [(phase, next_run, version, chat_id) for phase, next_run, chat_id in rows])
+
+def _reschedule_subscriptions(items):
+    # items: [(next_run_at, chat_id), ...]
+    if not items:
+        return
+    with _write_tx() as conn:
+        version = _next_version(conn)
+        conn.executemany(SQL_RESCHEDULE, [(next_run, version, chat_id) for next_run, chat_id in items])
+
+def _save_alert_rule(data, thresholds):
+    # thresholds: (rain_mm, frost_c, wind_ms)
+    with get_conn() as conn:
+        return conn.execute(SQL_SAVE_ALERT_RULE, (
+            data['chat_id'], data['chat_type'], data['lang'],
+            data['city'], data['country'], data['lat'], data['lon'], *thresholds
+        )).fetchone()
+
+def _get_alert_rule(chat_id):
+    return get_conn().execute(SQL_GET_ALERT_RULE, (chat_id,)).fetchone()
+
+def _delete_alert_rule(chat_id):
+    with get_conn() as conn:
+        conn.execute(SQL_DELETE_ALERT_RULE, (chat_id,))
+
+def _toggle_alert(chat_id, column, default, bit):
+    if column not in ALERT_COLUMNS:
+        raise ValueError(f"unknown alert column {column}")
+    with get_conn() as conn:
+        return conn.execute(SQL_TOGGLE_ALERT.format(column=column), (default, bit, chat_id)).fetchone()
+
+def _get_alert_rules(partitions, total_partitions):
+    if not partitions:
+        return []
+    owned = sorted(partitions)
+    sql = SQL_ALERT_RULES.format(placeholders=",".join("?" * len(owned)))
+    return get_conn().execute(sql, (total_partitions, total_partitions, total_partitions, *owned)).fetchall()
+
+def _enqueue_outbox(messages, queued=(), alert_states=()):
+    # Одной транзакцией: сообщения [(dedup_key, chat_id, text)], сдвиг расписания их подписок
+    # (строки delivered_row) и новые биты оповещений [(state, chat_id)]. Падение между ними невозможно:
+    # либо сообщение в outbox и подписка сдвинута, либо ни то ни другое. -> сколько сообщений добавлено
+    if not messages and not queued and not alert_states:
+        return 0
+    now = time.time()
+    with _write_tx() as conn:
+        before = conn.total_changes
+        conn.executemany(SQL_ENQUEUE, [(key, chat_id, text, now, now) for key, chat_id, text in messages])
+        added = conn.total_changes - before
+        if queued:
+            version = _next_version(conn)
+            conn.executemany(SQL_MARK_QUEUED, [(last_run, next_run, version, chat_id) for last_run, next_run, chat_id in queued])
+        conn.executemany(SQL_SET_ALERT_STATE, alert_states)
+    return added
+
+def _count_failures(conn, version, chat_ids, fail_limit):
+    # Очередное брошенное сообщение подряд; после fail_limit подписка отключается (0 — никогда)
+    conn.executemany(SQL_COUNT_FAILURE, [(version, chat_id) for chat_id in chat_ids])
+    if fail_limit:
+        conn.executemany(SQL_DEACTIVATE_FAILING, [(version, chat_id, fail_limit) for chat_id in chat_ids])
+
+def _claim_outbox(worker_id, partitions, total_partitions, limit, claim_ttl, max_age, fail_limit):
+    # -> (строки outbox своих партиций, готовые к отправке, в порядке постановки;
+    #     сколько строк старше max_age помечено expired)
+    if not partitions:
+        return [], 0
+    now = time.time()
+    owned = sorted(partitions)
+    sql = SQL_CLAIM_OUTBOX.format(placeholders=",".join("?" * len(owned)))
+    with _write_tx() as conn:
+        expired = conn.execute(SQL_EXPIRE_OUTBOX, (now, now - max_age, now)).fetchall()
+        # Устаревшее после неудачных попыток — такая же брошенная отправка, как в _settle_outbox
+        retried = [row['chat_id'] for row in expired if row['attempts'] > 0]
+        if retried:
+            _count_failures(conn, _next_version(conn), retried, fail_limit)
+        rows = conn.execute(sql, (
+            worker_id, now + claim_ttl, now, now, total_partitions, total_partitions, total_partitions, *owned, limit
+        )).fetchall()
+    return sorted(rows, key=lambda row: row['id']), len(expired)
+
+def _settle_outbox(sent, retry, failed, migrated, fail_limit):
+    # Итоги отправки одной транзакцией:
+    #   sent: [(id, chat_id)] — доставлено, счётчик неудач подписки сбрасывается
+    #   retry: [(not_before, id)] — временная ошибка, повтор позже
+    #   failed: [(id, chat_id, permanent)] — сообщение брошено; постоянная ошибка отключает подписку и оповещения,
+    #           иначе это очередная неудача подряд (после fail_limit подписка тоже отключается, 0 — никогда)
+    #   migrated: [(new_chat_id, id, old_chat_id)] — сообщение, подписка и оповещения переезжают на новый chat_id
+    now = time.time()
+    with _write_tx() as conn:
+        version = _next_version(conn)
+        conn.executemany(SQL_OUTBOX_DONE, [('sent', now, outbox_id) for outbox_id, _ in sent])
+        conn.executemany(SQL_RESET_FAILURES, [(version, chat_id) for chat_id in {chat_id for _, chat_id in sent}])
+        conn.executemany(SQL_OUTBOX_RETRY, retry)
+        conn.executemany(SQL_OUTBOX_DONE, [('failed', now, outbox_id) for outbox_id, _, _ in failed])
+        conn.executemany(SQL_DEACTIVATE, [(version, chat_id) for _, chat_id, permanent in failed if permanent])
+        conn.executemany(SQL_SET_ALERT_ACTIVE, [(0, chat_id, 0) for _, chat_id, permanent in failed if permanent])
+        _count_failures(conn, version, [chat_id for _, chat_id, permanent in failed if not permanent], fail_limit)
+        conn.executemany(SQL_OUTBOX_RETARGET, [(new_id, outbox_id) for new_id, outbox_id, _ in migrated])
+        conn.executemany(SQL_MIGRATE_CHAT, [(new_id, version, old_id) for new_id, _, old_id in migrated])
+        conn.executemany(SQL_MIGRATE_ALERT_RULE, [(new_id, old_id) for new_id, _, old_id in migrated])
+        conn.executemany(SQL_TOMBSTONE, [(old_id, version, now) for _, _, old_id in migrated])
+
+def _release_outbox(worker_id):
+    with get_conn() as conn:
+        conn.execute(SQL_RELEASE_OUTBOX, (worker_id,))
+
+def _purge_outbox(max_age):
+    with get_conn() as conn:
+        conn.execute("DELETE FROM outbox WHERE done_at < ?", (time.time() - max_age,))
+
+def _get_geocode(query, lang, max_age):
+    row = get_conn().execute(SQL_GET_GEOCODE, (query, lang)).fetchone()
+    if row is None or time.time() - row['created_at'] > max_age:
+        return None
+    return json.loads(row['results'])
+
+def _save_geocode(query, lang, results):
+    with get_conn() as conn:
+        conn.execute(SQL_SAVE_GEOCODE, (query, lang, json.dumps(results, ensure_ascii=False), time.time()))
+
+def _purge_geocode(max_age):
+    with get_conn() as conn:
+        conn.execute("DELETE FROM geocode_cache WHERE created_at < ?", (time.time() - max_age,))
+
+def _fsm_get(key, ttl):
+    row = get_conn().execute(
+        "SELECT state, data FROM fsm_states WHERE key = ? AND updated_at >= ?", (key, time.time() - ttl)
+    ).fetchone()
+    if row is None:
+        return None, {}
+    return row['state'], json.loads(row['data']) if row['data'] else {}
+
+# При записи в просроченную строку вторая половина (data/state) сбрасывается,
+# чтобы брошенный диалог не «воскресал»
+def _fsm_set_state(key, state, ttl):
+    now = time.time()
+    with get_conn() as conn:
+        conn.execute("""
+            INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, NULL, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                state = excluded.state,
+                data = CASE WHEN fsm_states.updated_at < ? THEN NULL ELSE fsm_states.data END,
+                updated_at = excluded.updated_at
+        """, (key, state, now, now - ttl))
+        conn.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data IS NULL", (key,))
+
+def _fsm_set_data(key, data, ttl):
+    encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None
+    now = time.time()
+    with get_conn() as conn:
+        conn.execute("""
+            INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, NULL, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                data = excluded.data,
+                state = CASE WHEN fsm_states.updated_at < ? THEN NULL ELSE fsm_states.state END,
+                updated_at = excluded.updated_at
+        """, (key, encoded, now, now - ttl))
+        conn.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data IS NULL", (key,))
+
+def _purge_fsm(ttl):
+    with get_conn() as conn:
+        return conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (time.time() - ttl,)).rowcount
+
+# --- ASYNC API ---
+async def init_db(path=None):
+    await run(_init_db, path)
+
+async def save_subscription(data):
+    return await run(_save_subscription, data)
+
+async def get_subscription_changes(since):
+    return await run(_get_subscription_changes, since)
+
+async def purge_tombstones(max_age):
+    await run(_purge_tombstones, max_age)
+
+async def get_all_subscriptions():
+    return await run(_get_all_subscriptions)
+
+async def delete_subscription(chat_id):
+    await run(_delete_subscription, chat_id)
+
+async def set_active(chat_id, active):
+    return await run(_set_active, chat_id, active)
+
+async def set_phases(rows):
+    await run(_set_phases, rows)
+
+async def reschedule_subscriptions(items):
+    await run(_reschedule_subscriptions, items)
+
+async def save_alert_rule(data, thresholds):
+    return await run(_save_alert_rule, data, thresholds)
+
+async def get_alert_rule(chat_id):
+    return await run(_get_alert_rule, chat_id)
+
+async def delete_alert_rule(chat_id):
+    await run(_delete_alert_rule, chat_id)
+
+async def toggle_alert(chat_id, column, default, bit):
+    return await run(_toggle_alert, chat_id, column, default, bit)
+
+async def get_alert_rules(partitions, total_partitions):
+    return await run(_get_alert_rules, partitions, total_partitions)
+
+async def enqueue_outbox(messages, queued=(), alert_states=()):
+    return await run(_enqueue_outbox, messages, queued, alert_states)
+
+async def claim_outbox(worker_id, partitions, total_partitions, limit, claim_ttl, max_age, fail_limit):
+    return await run(_claim_outbox, worker_id, partitions, total_partitions, limit, claim_ttl, max_age, fail_limit)
+
+async def settle_outbox(sent, retry, failed, migrated, fail_limit):
+    await run(_settle_outbox, sent, retry, failed, migrated, fail_limit)
+
+async def release_outbox(worker_id):
+    await run(_release_outbox, worker_id)
+
+async def purge_outbox(max_age):
+    await run(_purge_outbox, max_age)
+
+async def get_geocode(query, lang, max_age):
+    return await run(_get_geocode, query, lang, max_age)
+
+async def save_geocode(query, lang, results):
+    await run(_save_geocode, query, lang, results)
+
+async def purge_geocode(max_age):
+    await run(_purge_geocode, max_age)
+
+async def fsm_get(key, ttl):
+    return await run(_fsm_get, key, ttl)
+
+async def fsm_set_state(key, state, ttl):
+    await run(_fsm_set_state, key, state, ttl)
+
+async def fsm_set_data(key, data, ttl):
+    await run(_fsm_set_data, key, data, ttl)
+
+async def purge_fsm(ttl):
+    return await run(_purge_fsm, ttl)
+
+async def renew_leases(worker_id, partitions, ttl):
+    return await run(_renew_leases, worker_id, partitions, ttl)
+
+async def claim_subscriptions(worker_id, chat_ids, now, claim_ttl):
+    return await run(_claim_subscriptions, worker_id, chat_ids, now, claim_ttl)
+
+async def release_claims(worker_id):
+    await run(_release_claims, worker_id)
+
+async def release_leases(worker_id):
+    await run(_release_leases, worker_id)
@@ -0,0 +1,165 @@
+# delivery.py
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import (
+    TelegramRetryAfter, TelegramForbiddenError, TelegramMigrateToChat, TelegramBadRequest, TelegramNotFound
+)
+
+
+# Ответы Bad Request, означающие, что писать в чат боту больше нельзя (отобрали права, чат закрыт)
+NO_RIGHTS_MARKERS = (
+    'not enough rights', 'have no rights', 'need administrator rights', 'chat_write_forbidden', 'chat_restricted',
+)
+
+
+def classify_error(error):
+    # Причина неудачной отправки: forbidden / not_found / migrated — навсегда, transient — можно повторить
+    if isinstance(error, TelegramMigrateToChat):
+        return 'migrated'
+    if isinstance(error, TelegramForbiddenError):
+        return 'forbidden'
+    if isinstance(error, (TelegramBadRequest, TelegramNotFound)):
+        message = str(error).lower()
+        if 'chat not found' in message or 'peer_id_invalid' in message:
+            return 'not_found'
+        if any(marker in message for marker in NO_RIGHTS_MARKERS):
+            return 'forbidden'
+    return 'transient'
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SendJob:
+    __slots__ = ("chat_id", "text", "on_sent", "on_error")
+
+    def __init__(self, chat_id, text, on_sent=None, on_error=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.on_sent = on_sent
+        self.on_error = on_error
+
+
+class SendQueue:
+    # Очередь отправки с лимитами Telegram: ~30 сообщений/с всего и ~20/мин в одну группу.
+    # RetryAfter ставит всю очередь на паузу, сообщение не теряется.
+    def __init__(self, bot, workers=16, global_rate=30, group_rate=20, group_period=60):
+        self.bot = bot
+        self.workers = workers
+        self.queue = asyncio.Queue()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.group_rate = group_rate
+        self.group_period = group_period
+        self.chat_buckets = {}
+        self.paused_until = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, chat_id, text, on_sent=None, on_error=None):
+        self.queue.put_nowait(SendJob(chat_id, text, on_sent, on_error))
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        return f"sent={self.sent} failed={self.failed} retried={self.retried} pending={self.queue.qsize()}"
+
+    async def join(self, progress_interval=10):
+        # Ждём, пока очередь опустеет, периодически сообщая о прогрессе
+        waiter = asyncio.ensure_future(self.queue.join())
+        try:
+            while True:
+                done, _ = await asyncio.wait({waiter}, timeout=progress_interval)
+                if done:
+                    return
+                logging.info(f"Send queue progress: {self.stats()}")
+        finally:
+            waiter.cancel()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.is_full()}
+            bucket = TokenBucket(self.group_rate / self.group_period, self.group_rate)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _wait_pause(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._deliver(job)
+            except Exception as e:
+                logging.error(f"Send worker error for {job.chat_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, job):
+        while True:
+            await self._wait_pause()
+            # Отрицательные chat_id — группы и каналы
+            if job.chat_id < 0:
+                await self._chat_bucket(job.chat_id).acquire()
+            await self.global_bucket.acquire()
+            await self._wait_pause()
+            try:
+                await self.bot.send_message(job.chat_id, job.text)
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                logging.warning(f"Flood control: pausing sends for {e.retry_after}s")
+                continue
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Error sending to {job.chat_id}: {e}")
+                if job.on_error:
+                    job.on_error(e)
+                return
+            self.sent += 1
+            if job.on_sent:
+                job.on_sent()
+            return
@@ -0,0 +1,34 @@
+# fsm_storage.py
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from database import fsm_get, fsm_set_state, fsm_set_data, purge_fsm
+
+
+class SQLiteStorage(BaseStorage):
+    # FSM-хранилище в SQLite: состояния переживают рестарт, а брошенные диалоги
+    # (ищут город и не жмут кнопку) удаляются после ttl секунд простоя.
+    def __init__(self, ttl=86400):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await fsm_set_state(self.key_builder.build(key), state, self.ttl)
+
+    async def get_state(self, key):
+        state, _ = await fsm_get(self.key_builder.build(key), self.ttl)
+        return state
+
+    async def set_data(self, key, data):
+        await fsm_set_data(self.key_builder.build(key), dict(data), self.ttl)
+
+    async def get_data(self, key):
+        _, data = await fsm_get(self.key_builder.build(key), self.ttl)
+        return data
+
+    async def purge(self):
+        return await purge_fsm(self.ttl)
+
+    async def close(self):
+        pass
@@ -0,0 +1,289 @@
+# gazetteer.py
+# Локальный справочник городов из дампа GeoNames: поиск без обращения к геокодеру.
+#
+# Сборка индекса (файлы с https://download.geonames.org/export/dump/):
+#   python gazetteer.py build cities15000.txt --admin1 admin1CodesASCII.txt \
+#       --countries countryInfo.txt --alternate-names alternateNamesV2.txt -o gazetteer.idx
+# Проверка:
+#   python gazetteer.py search "киев" --lang ru
+import argparse
+import bisect
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import unicodedata
+
+# Языки локализованных названий (те же, что понимает search_cities)
+LANGS = ("en", "ru", "uk", "de", "fr", "pl")
+
+# Формат файла (little-endian):
+#   заголовок: magic, число городов, число ключей, смещения таблиц городов, ключей и строк
+#   город:     lat, lon, население, код страны, смещения записей имени / региона / страны
+#   ключ:      смещение нормализованного имени, номер города (отсортированы по имени, затем по населению)
+#   строки:    длина (u16) + utf-8; запись имени — "Имя\ten=...\tru=..."
+MAGIC = b"WGZ1"
+HEADER = struct.Struct("<4s5I")
+CITY = struct.Struct("<ffI2s2xIII")
+KEY = struct.Struct("<II")
+STR_LEN = struct.Struct("<H")
+
+# Сколько ключей просматривать при поиске по префиксу ("к" совпадает с десятками тысяч)
+SCAN_LIMIT = 2000
+
+_PUNCT = str.maketrans({c: " " for c in "-'’`.,()"})
+
+
+def normalize_name(text):
+    # Регистр, диакритика и дефисы не важны: "Kyïv", "kyiv" и "Ky-iv" ищутся одинаково
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.translate(_PUNCT).split())
+
+
+class _Keys:
+    # Ленивая последовательность ключей поверх mmap — для bisect без загрузки в память
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.n_keys
+
+    def __getitem__(self, i):
+        return self.index._key(i)[0]
+
+
+class Gazetteer:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n_cities, self.n_keys, self._cities_off, self._keys_off, self._strings_off = \
+            HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a gazetteer index")
+        self._keys = _Keys(self)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def __len__(self):
+        return self.n_cities
+
+    def _string(self, offset):
+        (length,) = STR_LEN.unpack_from(self._mm, self._strings_off + offset)
+        start = self._strings_off + offset + STR_LEN.size
+        return self._mm[start:start + length]
+
+    def _key(self, i):
+        key_off, city = KEY.unpack_from(self._mm, self._keys_off + i * KEY.size)
+        return self._string(key_off), city
+
+    def _localized(self, offset, lang):
+        name, *variants = self._string(offset).decode().split("\t")
+        prefix = lang + "="
+        for variant in variants:
+            if variant.startswith(prefix):
+                return variant[len(prefix):]
+        return name
+
+    def city(self, idx, lang="en"):
+        # Тот же формат, что у результатов геокодера Open-Meteo (+ id записи в индексе)
+        lat, lon, population, cc, name_off, admin1_off, country_off = \
+            CITY.unpack_from(self._mm, self._cities_off + idx * CITY.size)
+        return {
+            "id": idx,
+            "name": self._localized(name_off, lang),
+            "country_code": cc.decode(),
+            "country": self._localized(country_off, lang) if country_off else cc.decode(),
+            "admin1": self._localized(admin1_off, lang) if admin1_off else "",
+            "latitude": round(lat, 4),
+            "longitude": round(lon, 4),
+            "population": population,
+        }
+
+    def search(self, query, lang="en", limit=5, prefix=False):
+        # Точные совпадения имени (или начала имени при prefix=True), крупные города выше
+        q = normalize_name(query).encode()
+        if not q:
+            return []
+        found = {}
+        i = bisect.bisect_left(self._keys, q)
+        end = min(self.n_keys, i + SCAN_LIMIT)
+        while i < end:
+            key, city = self._key(i)
+            exact = key == q
+            if not exact and not (prefix and key.startswith(q)):
+                break
+            found[city] = found.get(city, False) or exact
+            i += 1
+        ranked = sorted(found, key=lambda c: (not found[c], -self._population(c)))
+        return [self.city(c, lang) for c in ranked[:limit]]
+
+    def _population(self, idx):
+        return CITY.unpack_from(self._mm, self._cities_off + idx * CITY.size)[2]
+
+
+def open_index(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        index = Gazetteer(path)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Gazetteer disabled, cannot open {path}: {e}")
+        return None
+    logging.info(f"Gazetteer loaded: {len(index)} cities from {path}")
+    return index
+
+
+# --- СБОРКА ИНДЕКСА ---
+
+def _read_tsv(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            yield line.rstrip("\n").split("\t")
+
+
+def _read_alternate_names(path, wanted):
+    # geonameid -> {lang: name}; официальные (isPreferredName) названия важнее прочих
+    names = {}
+    for row in _read_tsv(path):
+        if len(row) < 4 or row[2] not in LANGS:
+            continue
+        geoname_id = int(row[1])
+        if geoname_id not in wanted:
+            continue
+        preferred = len(row) > 4 and row[4] == "1"
+        colloquial_or_historic = len(row) > 7 and (row[6] == "1" or row[7] == "1")
+        if colloquial_or_historic:
+            continue
+        current = names.setdefault(geoname_id, {})
+        if row[2] not in current or (preferred and not current[row[2]][1]):
+            current[row[2]] = (row[3], preferred)
+    return {gid: {lang: name for lang, (name, _) in langs.items()} for gid, langs in names.items()}
+
+
+def build(cities_path, out_path, admin1_path=None, countries_path=None, alternate_names_path=None, min_population=0):
+    cities = []
+    for row in _read_tsv(cities_path):
+        if len(row) < 15 or row[6] != "P":
+            continue
+        population = int(row[14] or 0)
+        if population < min_population:
+            continue
+        cities.append({
+            "id": int(row[0]), "name": row[1], "ascii": row[2],
+            "alternates": [n for n in row[3].split(",") if n],
+            "lat": float(row[4]), "lon": float(row[5]), "cc": row[8][:2] or "XX",
+            "admin1": f"{row[8]}.{row[10]}", "population": population,
+        })
+
+    admin1 = {}  # "UA.12" -> (имя, geonameid)
+    if admin1_path:
+        for row in _read_tsv(admin1_path):
+            admin1[row[0]] = (row[1], int(row[3]) if len(row) > 3 and row[3] else None)
+    countries = {}  # "UA" -> (имя, geonameid)
+    if countries_path:
+        for row in _read_tsv(countries_path):
+            countries[row[0]] = (row[4], int(row[16]) if len(row) > 16 and row[16] else None)
+
+    localized = {}
+    if alternate_names_path:
+        wanted = {c["id"] for c in cities}
+        wanted.update(gid for _, gid in admin1.values() if gid)
+        wanted.update(gid for _, gid in countries.values() if gid)
+        localized = _read_alternate_names(alternate_names_path, wanted)
+
+    strings = bytearray(STR_LEN.pack(0))  # смещение 0 — пустая строка
+    offsets = {}
+
+    def add_string(text):
+        if text not in offsets:
+            data = text.encode()[:0xFFFF]
+            offsets[text] = len(strings)
+            strings.extend(STR_LEN.pack(len(data)))
+            strings.extend(data)
+        return offsets[text]
+
+    def add_record(name, geoname_id):
+        variants = localized.get(geoname_id, {})
+        return add_string("\t".join([name] + [f"{lang}={variants[lang]}" for lang in LANGS if lang in variants]))
+
+    city_rows = bytearray()
+    keys = []
+    for idx, c in enumerate(cities):
+        region = admin1.get(c["admin1"])
+        country = countries.get(c["cc"])
+        city_rows.extend(CITY.pack(
+            c["lat"], c["lon"], min(c["population"], 0xFFFFFFFF), c["cc"].encode(),
+            add_record(c["name"], c["id"]),
+            add_record(*region) if region else 0,
+            add_record(*country) if country else 0,
+        ))
+        names = [c["name"], c["ascii"]] + c["alternates"] + list(localized.get(c["id"], {}).values())
+        for key in {normalize_name(n) for n in names if len(n) <= 64}:
+            if key:
+                keys.append((key.encode(), -c["population"], idx))
+
+    keys.sort()
+    key_rows = bytearray()
+    for key, _, idx in keys:
+        key_rows.extend(KEY.pack(add_string(key.decode()), idx))
+
+    cities_off = HEADER.size
+    keys_off = cities_off + len(city_rows)
+    strings_off = keys_off + len(key_rows)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(cities), len(keys), cities_off, keys_off, strings_off))
+        f.write(city_rows)
+        f.write(key_rows)
+        f.write(strings)
+    os.replace(tmp_path, out_path)
+    return len(cities), len(keys)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the offline city index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="build an index from a GeoNames cities dump")
+    p_build.add_argument("cities")
+    p_build.add_argument("--admin1")
+    p_build.add_argument("--countries")
+    p_build.add_argument("--alternate-names")
+    p_build.add_argument("--min-population", type=int, default=0)
+    p_build.add_argument("-o", "--output", default="gazetteer.idx")
+    p_search = sub.add_parser("search", help="look up a city in an existing index")
+    p_search.add_argument("query")
+    p_search.add_argument("--lang", default="en")
+    p_search.add_argument("--prefix", action="store_true")
+    p_search.add_argument("--index", default="gazetteer.idx")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        start = time.perf_counter()
+        n_cities, n_keys = build(
+            args.cities, args.output, args.admin1, args.countries, args.alternate_names, args.min_population
+        )
+        print(f"{args.output}: {n_cities} cities, {n_keys} names, "
+              f"{os.path.getsize(args.output) / 1024 / 1024:.1f} MB in {time.perf_counter() - start:.1f}s")
+    else:
+        index = Gazetteer(args.index)
+        start = time.perf_counter()
+        results = index.search(args.query, args.lang, limit=10, prefix=args.prefix)
+        elapsed = (time.perf_counter() - start) * 1000
+        for city in results:
+            print(f"{city['name']}, {city['admin1']}, {city['country']} "
+                  f"({city['latitude']}, {city['longitude']}) pop {city['population']}")
+        print(f"{len(results)} results in {elapsed:.2f} ms", file=sys.stderr)
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -33,7 +33,18 @@ TEXTS = {
         "btn_stop": "🛑 Unsubscribe",
         "stop_success": "✅ Subscription stopped.",
         "no_sub": "❌ You don't have an active subscription. Type /setup.",
-        "help_text": "📚 <b>Help & Instructions</b>\n\n<b>Commands:</b>\n/start - Restart\n/setup - Subscribe to weather\n/settings - Manage subscription\n/help - Show this message\n\n<b>👥 How to use in Groups/Channels:</b>\n1. Add bot to the group.\n2. <b>Make it an Admin</b> (required to see messages).\n3. Type /setup in the chat."
+        "settings_paused": "\n\n⏸ <b>Delivery is paused</b>: messages to this chat could not be delivered. Run /setup or change the city or time below to turn it back on.",
+        "alerts_title": "🔔 <b>Weather alerts for {city}</b>\n\nI'll message you once when a condition is expected within the next {hours} hours. Tap to turn conditions on or off.",
+        "alert_rule_rain": "☔ Rain from {val} mm/h",
+        "alert_rule_frost": "🥶 Frost at {val}°C or below",
+        "alert_rule_wind": "💨 Wind from {val} m/s",
+        "btn_alert_stop": "🔕 Turn off alerts",
+        "alerts_off": "🔕 Weather alerts are turned off.",
+        "alert_msg": "🔔 <b>{city} ({country})</b>\n\n{lines}",
+        "alert_rain": "☔ Rain expected from {time}: <b>{val} mm/h</b>",
+        "alert_frost": "🥶 Frost expected from {time}: <b>{val}°C</b>",
+        "alert_wind": "💨 Strong wind expected from {time}: <b>{val} m/s</b>",
+        "help_text": "📚 <b>Help & Instructions</b>\n\n<b>Commands:</b>\n/start - Restart\n/setup - Subscribe to weather\n/settings - Manage subscription\n/alerts - Rain, frost and wind alerts\n/help - Show this message\n\n<b>👥 How to use in Groups/Channels:</b>\n1. Add bot to the group.\n2. <b>Make it an Admin</b> (required to see messages).\n3. Type /setup in the chat."
     },
     "ru": {
         "start": "👋 Привет! Я @WeaYouBot (Your Weather Bot).\n\n🔹 <b>Мгновенный прогноз:</b> Просто напиши <b>название города</b>.\n🔹 <b>Подписка:</b> Жми /setup, чтобы получать погоду по расписанию.\n\nЖми /help для помощи.",
@@ -67,7 +78,18 @@ TEXTS = {
         "btn_stop": "🛑 Отключить рассылку",
         "stop_success": "✅ Подписка отключена.",
         "no_sub": "❌ У вас нет активной подписки. Нажмите /setup.",
-        "help_text": "📚 <b>Помощь и Инструкция</b>\n\n<b>Команды:</b>\n/start - Старт\n/setup - Настроить погоду\n/settings - Управление подпиской\n/help - Показать это сообщение\n\n<b>👥 Как использовать в Группах/Каналах:</b>\n1. Добавьте бота в чат.\n2. <b>Сделайте его Админом</b> (обязательно).\n3. Напишите /setup в чате."
+        "settings_paused": "\n\n⏸ <b>Рассылка приостановлена</b>: сообщения в этот чат не доставлялись. Чтобы включить её снова, нажмите /setup или измените город или время ниже.",
+        "alerts_title": "🔔 <b>Оповещения о погоде: {city}</b>\n\nНапишу один раз, когда условие ожидается в ближайшие {hours} ч. Нажмите, чтобы включить или выключить условие.",
+        "alert_rule_rain": "☔ Дождь от {val} мм/ч",
+        "alert_rule_frost": "🥶 Мороз {val}°C и ниже",
+        "alert_rule_wind": "💨 Ветер от {val} м/с",
+        "btn_alert_stop": "🔕 Выключить оповещения",
+        "alerts_off": "🔕 Оповещения о погоде выключены.",
+        "alert_msg": "🔔 <b>{city} ({country})</b>\n\n{lines}",
+        "alert_rain": "☔ Ожидается дождь с {time}: <b>{val} мм/ч</b>",
+        "alert_frost": "🥶 Ожидается мороз с {time}: <b>{val}°C</b>",
+        "alert_wind": "💨 Ожидается сильный ветер с {time}: <b>{val} м/с</b>",
+        "help_text": "📚 <b>Помощь и Инструкция</b>\n\n<b>Команды:</b>\n/start - Старт\n/setup - Настроить погоду\n/settings - Управление подпиской\n/alerts - Оповещения о дожде, заморозках и ветре\n/help - Показать это сообщение\n\n<b>👥 Как использовать в Группах/Каналах:</b>\n1. Добавьте бота в чат.\n2. <b>Сделайте его Админом</b> (обязательно).\n3. Напишите /setup в чате."
     },
     "uk": {
         "start": "👋 Привіт! Я @WeaYouBot (Your Weather Bot).\n\n🔹 <b>Миттєвий прогноз:</b> Просто напиши <b>назву міста</b>.\n🔹 <b>Підписка:</b> Тисни /setup, щоб отримувати погоду за розкладом.\n\nТисни /help для довідки.",
@@ -101,7 +123,18 @@ TEXTS = {
         "btn_stop": "🛑 Відписатися",
         "stop_success": "✅ Підписку скасовано.",
         "no_sub": "❌ У вас немає активної підписки. Натисніть /setup.",
-        "help_text": "📚 <b>Довідка та Інструкція</b>\n\n<b>Команды:</b>\n/start - Старт\n/setup - Налаштувати погоду\n/settings - Керування підпискою\n/help - Показати це повідомлення\n\n<b>👥 Як використовувати в Групах/Каналах:</b>\n1. Додайте бота в чат.\n2. <b>Зробіть його Адміном</b> (обов'язково).\n3. Напишіть /setup у чаті."
+        "settings_paused": "\n\n⏸ <b>Розсилку призупинено</b>: повідомлення в цей чат не доставлялися. Щоб увімкнути її знову, натисніть /setup або змініть місто чи час нижче.",
+        "alerts_title": "🔔 <b>Сповіщення про погоду: {city}</b>\n\nНапишу один раз, коли умова очікується в найближчі {hours} год. Натисніть, щоб увімкнути або вимкнути умову.",
+        "alert_rule_rain": "☔ Дощ від {val} мм/год",
+        "alert_rule_frost": "🥶 Мороз {val}°C і нижче",
+        "alert_rule_wind": "💨 Вітер від {val} м/с",
+        "btn_alert_stop": "🔕 Вимкнути сповіщення",
+        "alerts_off": "🔕 Сповіщення про погоду вимкнено.",
+        "alert_msg": "🔔 <b>{city} ({country})</b>\n\n{lines}",
+        "alert_rain": "☔ Очікується дощ з {time}: <b>{val} мм/год</b>",
+        "alert_frost": "🥶 Очікується мороз з {time}: <b>{val}°C</b>",
+        "alert_wind": "💨 Очікується сильний вітер з {time}: <b>{val} м/с</b>",
+        "help_text": "📚 <b>Довідка та Інструкція</b>\n\n<b>Команды:</b>\n/start - Старт\n/setup - Налаштувати погоду\n/settings - Керування підпискою\n/alerts - Сповіщення про дощ, заморозки та вітер\n/help - Показати це повідомлення\n\n<b>👥 Як використовувати в Групах/Каналах:</b>\n1. Додайте бота в чат.\n2. <b>Зробіть його Адміном</b> (обов'язково).\n3. Напишіть /setup у чаті."
     }
 }
 
@@ -121,14 +154,24 @@ def get_text(lang, key, **kwargs):
     l = lang if lang in TEXTS else "en"
     return TEXTS[l][key].format(**kwargs)
 
+def wmo_group(code):
+    if code > 95: return 95
+    elif code >= 80: return 61
+    elif code >= 60: return 61
+    elif code >= 50: return 51
+    elif code >= 45: return 45
+    elif code >= 3: return 3
+    elif code >= 1: return 1
+    return code
+
+# Готовая таблица код WMO (0-99) -> текст для каждого языка
+WMO_TABLE = {
+    l: tuple(WEATHER_CODES.get(wmo_group(code), WEATHER_CODES[0])[l] for code in range(100))
+    for l in TEXTS
+}
+
 def get_wmo(code, lang):
     l = lang if lang in TEXTS else "en"
-    code_map = code
-    if code > 95: code_map = 95
-    elif code >= 80: code_map = 61
-    elif code >= 60: code_map = 61
-    elif code >= 50: code_map = 51
-    elif code >= 45: code_map = 45
-    elif code >= 3: code_map = 3
-    elif code >= 1: code_map = 1
-    return WEATHER_CODES.get(code_map, WEATHER_CODES[0])[l]
\ No newline at end of file
+    if 0 <= code < 100:
+        return WMO_TABLE[l][int(code)]
+    return WEATHER_CODES.get(wmo_group(code), WEATHER_CODES[0])[l]
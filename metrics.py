@@ -0,0 +1,162 @@
+# metrics.py
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+# Минимальная реализация метрик в текстовом формате Prometheus (без внешних зависимостей)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.type}"]
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class CallbackMetric(Metric):
+    # Значения считываются в момент запроса: fn() -> {(label values...): value}
+    def __init__(self, name, doc, fn, labels=(), type="gauge"):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+        self.type = type
+
+    def samples(self):
+        try:
+            self.values = self.fn()
+        except Exception as e:
+            logging.warning(f"Metric {self.name} failed: {e}")
+            self.values = {}
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', bound))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+REGISTRY = []
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.header()
+        lines += metric.samples()
+    return "\n".join(lines) + "\n"
+
+
+# --- МЕТРИКИ БОТА ---
+UPSTREAM_LATENCY = Histogram("weather_upstream_seconds", "Open-Meteo request latency", labels=("api", "kind"))
+UPSTREAM_ERRORS = Counter("weather_upstream_errors_total", "Failed Open-Meteo requests", labels=("api",))
+TICK_DURATION = Histogram("weather_sender_tick_seconds", "sender_job tick duration")
+DELIVERIES = Counter("weather_deliveries_total", "Scheduled deliveries by outcome", labels=("status",))
+ALERTS_SENT = Counter("weather_alerts_total", "Weather alerts sent by condition", labels=("condition",))
+SEND_FAILURES = Counter("weather_send_failures_total", "Failed scheduled sends by cause", labels=("kind",))
+CATCHUP = Counter("weather_catchup_total", "Deliveries missed during downtime by outcome", labels=("outcome",))
+OUTBOX = Counter("weather_outbox_total", "Outbox messages by event", labels=("event",))
+PREWARMED = Counter("weather_prewarm_cells_total", "Forecast cells fetched ahead of delivery")
+DB_LATENCY = Histogram("weather_db_seconds", "SQLite operation time (queue wait included)", labels=("op",))
+HANDLER_LATENCY = Histogram("weather_handler_seconds", "Update handler latency", labels=("handler",))
+HANDLER_ERRORS = Counter("weather_handler_errors_total", "Update handlers that raised", labels=("handler",))
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: время работы каждого сработавшего хендлера
+    async def __call__(self, handler, event, data):
+        name = getattr(data.get("handler"), "callback", handler)
+        name = getattr(name, "__name__", "unknown")
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, handler=name)
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host, port):
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logging.warning(f"Metrics server disabled, cannot bind {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,97 @@
+# rebalance.py
+# Перераспределение фаз интервальных подписок (2 ч / 12 ч) по наименее загруженным минутам суток.
+# Учитывается и пик ежедневных рассылок в target_hour:00.
+#
+#   python rebalance.py            # только показать, что изменится
+#   python rebalance.py --apply    # записать новые фазы (можно на работающем боте)
+import argparse
+import asyncio
+import os
+from collections import Counter
+
+from dotenv import load_dotenv
+
+import database
+from database import compute_next_run, phase_slots, parse_ts
+
+
+def current_slots(sub):
+    # Минуты суток, в которые подписка срабатывает сейчас
+    if sub['interval_hours'] == 24:
+        return [(sub['target_hour'] or 0) * 60]
+    phase = sub['phase_minutes']
+    if phase is None:
+        next_run = parse_ts(sub['next_run_at'])
+        phase = (next_run.hour * 60 + next_run.minute) % (sub['interval_hours'] * 60)
+    return phase_slots(sub['interval_hours'], phase)
+
+
+def plan(subs):
+    # Жадно: сначала частые подписки, каждой — фаза с минимальной суммарной нагрузкой в её слотах.
+    # Если текущая фаза уже среди лучших, она сохраняется. -> {chat_id: новая фаза}
+    load = [0] * 1440
+    interval_subs = []
+    for sub in subs:
+        if sub['interval_hours'] == 24:
+            load[(sub['target_hour'] or 0) * 60] += 1
+        else:
+            interval_subs.append(sub)
+    # fold[P][p] — суммарная нагрузка минут, сравнимых с p по модулю периода P
+    folds = {}
+    for sub in interval_subs:
+        period = sub['interval_hours'] * 60
+        if period not in folds:
+            folds[period] = [sum(load[p::period]) for p in range(period)]
+
+    phases = {}
+    for sub in sorted(interval_subs, key=lambda s: s['interval_hours']):
+        fold = folds[sub['interval_hours'] * 60]
+        lowest = min(fold)
+        phase = sub['phase_minutes']
+        if phase is None or fold[phase] != lowest:
+            phase = fold.index(lowest)
+        phases[sub['chat_id']] = phase
+        for minute in phase_slots(sub['interval_hours'], phase):
+            load[minute] += 1
+            for period, other in folds.items():
+                other[minute % period] += 1
+    return phases
+
+
+def peak(slots_by_sub):
+    load = Counter(minute for slots in slots_by_sub for minute in slots)
+    return max(load.values(), default=0)
+
+
+async def main(args):
+    await database.init_db(args.db)
+    try:
+        subs = [sub for sub in await database.get_all_subscriptions() if sub['active']]
+        phases = plan(subs)
+        changed = [
+            sub for sub in subs
+            if sub['chat_id'] in phases and phases[sub['chat_id']] != sub['phase_minutes']
+        ]
+        interval_subs = [sub for sub in subs if sub['chat_id'] in phases]
+        before = peak(current_slots(sub) for sub in interval_subs)
+        after = peak(phase_slots(sub['interval_hours'], phases[sub['chat_id']]) for sub in interval_subs)
+        print(f"{len(subs)} subscriptions, {len(phases)} with an interval, {len(changed)} change phase")
+        print(f"busiest minute for interval subscriptions: {before} deliveries before, {after} after")
+        if args.apply and changed:
+            rows = []
+            for sub in changed:
+                phase = phases[sub['chat_id']]
+                last_run = parse_ts(sub['last_run'])
+                rows.append((phase, compute_next_run(sub['interval_hours'], None, last_run, phase), sub['chat_id']))
+            await database.set_phases(rows)
+            print(f"updated {len(rows)} subscriptions")
+    finally:
+        await database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Spread interval subscriptions over the least loaded minutes")
+    load_dotenv()
+    parser.add_argument("--db", default=os.getenv("DB_FILE", "weather_bot_v2.db"))
+    parser.add_argument("--apply", action="store_true", help="write the new phases (default: dry run)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,114 @@
+# registry.py
+from database import parse_ts
+
+# Колонки subscriptions, которые держим в памяти (claimed_by/claim_until живут только в БД)
+FIELDS = (
+    'chat_id', 'chat_type', 'lang_code', 'city_name', 'country_code', 'lat', 'lon', 'forecast_type',
+    'interval_hours', 'target_hour', 'phase_minutes', 'last_run', 'next_run_at', 'active', 'fail_count', 'version'
+)
+
+
+class Subscription:
+    # Компактная запись подписки; sub['поле'] работает как у sqlite3.Row
+    __slots__ = FIELDS + ('cell',)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return FIELDS
+
+
+def _bucket(when):
+    # Минутная корзина next_run_at
+    return int(when.timestamp() // 60)
+
+
+class SubscriptionRegistry:
+    # Все подписки в памяти процесса: O(1) по chat_id и индекс по минуте отправки.
+    # Изменения из других процессов подтягиваются по версии строк (см. database.get_subscription_changes).
+    def __init__(self, cell_fn):
+        self.cell_fn = cell_fn
+        self.subs = {}
+        self.by_bucket = {}
+        self.version = -1
+
+    def __len__(self):
+        return len(self.subs)
+
+    def get(self, chat_id):
+        return self.subs.get(chat_id)
+
+    def clear(self):
+        self.subs.clear()
+        self.by_bucket.clear()
+        self.version = -1
+
+    def _index(self, sub):
+        if sub.active and sub.next_run_at is not None:
+            self.by_bucket.setdefault(_bucket(sub.next_run_at), set()).add(sub.chat_id)
+
+    def _unindex(self, sub):
+        if sub.next_run_at is None:
+            return
+        bucket = _bucket(sub.next_run_at)
+        ids = self.by_bucket.get(bucket)
+        if ids is not None:
+            ids.discard(sub.chat_id)
+            if not ids:
+                del self.by_bucket[bucket]
+
+    def upsert(self, row):
+        sub = Subscription()
+        for field in FIELDS:
+            setattr(sub, field, row[field])
+        sub.last_run = parse_ts(sub.last_run)
+        sub.next_run_at = parse_ts(sub.next_run_at)
+        sub.cell = self.cell_fn(sub.lat, sub.lon)
+        self.remove(sub.chat_id)
+        self.subs[sub.chat_id] = sub
+        self._index(sub)
+        return sub
+
+    def remove(self, chat_id):
+        sub = self.subs.pop(chat_id, None)
+        if sub is not None:
+            self._unindex(sub)
+        return sub
+
+    def apply(self, rows, tombstones, version):
+        # rows — изменённые строки, tombstones — [(chat_id, version)] удалённых; применяем по порядку версий
+        changes = [(row['version'], 1, row) for row in rows] + [(v, 0, chat_id) for chat_id, v in tombstones]
+        changes.sort(key=lambda change: change[:2])
+        for _, is_row, item in changes:
+            if is_row:
+                self.upsert(item)
+            else:
+                self.remove(item)
+        self.version = max(self.version, version)
+
+    def _owned(self, chat_ids, partitions, total_partitions):
+        return [chat_id for chat_id in chat_ids if chat_id % total_partitions in partitions]
+
+    def due(self, now, partitions, total_partitions, limit):
+        # chat_id подписок своих партиций с next_run_at <= now, сначала самые давние
+        now_bucket = _bucket(now)
+        result = []
+        for bucket in sorted(b for b in self.by_bucket if b <= now_bucket):
+            for chat_id in self._owned(self.by_bucket[bucket], partitions, total_partitions):
+                if self.subs[chat_id].next_run_at <= now:
+                    result.append(chat_id)
+            if len(result) >= limit:
+                return result[:limit]
+        return result
+
+    def upcoming(self, start, end, partitions, total_partitions):
+        # Подписки своих партиций с start < next_run_at <= end, по времени отправки
+        result = []
+        for bucket in sorted(b for b in self.by_bucket if _bucket(start) <= b <= _bucket(end)):
+            for chat_id in self._owned(self.by_bucket[bucket], partitions, total_partitions):
+                sub = self.subs[chat_id]
+                if start < sub.next_run_at <= end:
+                    result.append(sub)
+        result.sort(key=lambda sub: sub.next_run_at)
+        return result
@@ -0,0 +1,82 @@
+# render.py
+from functools import lru_cache
+
+from locales import WMO_TABLE, get_text, get_wmo
+from cache import TTLCache
+
+# Эмодзи погоды (первое слово описания WMO) для недельного прогноза
+WMO_EMOJI = {lang: tuple(desc.split()[0] for desc in table) for lang, table in WMO_TABLE.items()}
+
+# Готовые сообщения: один рендер на (ячейка, режим, язык, город, время прогноза)
+report_cache = TTLCache(maxsize=20000, ttl=3 * 3600)
+
+
+@lru_cache(maxsize=512)
+def get_flag(country_code):
+    if not country_code: return "🌍"
+    return chr(127397 + ord(country_code[0])) + chr(127397 + ord(country_code[1]))
+
+def wmo_emoji(code, lang):
+    if not 0 <= code < 100:
+        return get_wmo(code, lang).split()[0]
+    table = WMO_EMOJI.get(lang) or WMO_EMOJI["en"]
+    return table[int(code)]
+
+@lru_cache(maxsize=64)
+def short_date(iso_date):
+    # "2024-05-17" -> "17.05"
+    return f"{iso_date[8:10]}.{iso_date[5:7]}"
+
+def render_report(payload, mode, lang, city, country_code):
+    # payload — полный ответ Open-Meteo (current + daily на 7 дней)
+    if mode == 'daily':
+        daily = payload['daily']
+        curr = payload['current']
+        return get_text(
+            lang, "daily_msg",
+            city=city,
+            country=get_flag(country_code),
+            desc=get_wmo(daily['weather_code'][0], lang),
+            t_now=curr['temperature_2m'],
+            t_feels=curr['apparent_temperature'],
+            t_max=daily['temperature_2m_max'][0],
+            t_min=daily['temperature_2m_min'][0],
+            rain=daily['precipitation_sum'][0],
+            wind=daily['wind_speed_10m_max'][0],
+            sunrise=daily['sunrise'][0].split('T')[1],
+            sunset=daily['sunset'][0].split('T')[1]
+        )
+    elif mode == 'weekly':
+        daily = payload['daily']
+        lines = [
+            f"▪️ {short_date(day)}: {wmo_emoji(code, lang)} <b>{t_min}°C</b> … <b>{t_max}°C</b>"
+            for day, code, t_max, t_min in zip(
+                daily['time'][:7], daily['weather_code'], daily['temperature_2m_max'], daily['temperature_2m_min']
+            )
+        ]
+        return get_text(
+            lang, "weekly_msg",
+            city=city,
+            country=get_flag(country_code),
+            forecast_text="\n".join(lines)
+        )
+    w = payload['current']
+    return get_text(
+        lang, "weather_msg",
+        city=city,
+        country=get_flag(country_code),
+        desc=get_wmo(w['weather_code'], lang),
+        temp=w['temperature_2m'],
+        feels=w['apparent_temperature'],
+        wind=w['wind_speed_10m'],
+        hum=w['relative_humidity_2m']
+    )
+
+def render_cached(cell, payload, mode, lang, city, country_code):
+    # Одинаковое сообщение для сотен чатов собирается один раз
+    key = (cell, mode, lang, city, country_code, payload['current']['time'])
+    text = report_cache.get(key)
+    if text is None:
+        text = render_report(payload, mode, lang, city, country_code)
+        report_cache.set(key, text)
+    return text
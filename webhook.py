@@ -0,0 +1,64 @@
+# webhook.py
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram.types import Update
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    # Приём обновлений от Telegram по HTTP. Ответ 200 отдаётся сразу, обработка идёт
+    # в фоне; число одновременно обрабатываемых обновлений ограничено max_inflight.
+    # Когда все слоты заняты, запрос ждёт слот — Telegram сам притормозит доставку.
+    # Без секрета сервер не работает: иначе любой POST на порт сойдёт за обновление от Telegram.
+    def __init__(self, dp, bot, path, secret, max_inflight=100):
+        if not secret:
+            raise ValueError("webhook secret token is required")
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.slots = asyncio.Semaphore(max_inflight)
+        self.tasks = set()
+        self.runner = None
+
+    async def handle(self, request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.warning(f"Bad webhook payload: {e}")
+            return web.Response(status=400)
+
+        await self.slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logging.error(f"Error handling update {update.update_id}: {e}")
+        finally:
+            self.slots.release()
+
+    async def start(self, host, port):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logging.info(f"Webhook server listening on {host}:{port}{self.path}")
+
+    async def stop(self, timeout=10):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)